@@ -1,7 +1,7 @@
+import time
 from mesa import Agent
-import networkx as nx
-import matplotlib.pyplot as plt
-import random
+from lattice import ROAD, TRAFFIC_LIGHT, DESTINATION
+from router import REPAIR_WINDOW
 
 
 class Car(Agent):
@@ -10,39 +10,99 @@ class Car(Agent):
     Attributes:
         unique_id: Agent's ID 
         direction: Randomly chosen direction chosen from one of eight directions
+        cursor, end: The path still to follow, model.arena.data[cursor:end] (node indices), the next node first
     """
-    def __init__(self, unique_id, model, goal, init_model, pos, patience = 5):
+    # The fields of the car live in slots and its path in the arena shared by every car of the model. mesa.Agent has
+    # no slots, so each car still has a __dict__ (unique_id, model, pos): the compact store of cars is the array engine.
+    __slots__ = ["goal", "patience", "router", "penalties", "cursor", "end", "dir", "spawn_step", "baseline"]
+
+    def __init__(self, unique_id, model, goal, router, pos, patience = 5, path = None):
         """
         Creates a new random agent.
         Args:
             unique_id: The agent's ID
             model: Model reference for the agent
+            router: Routing engine of the city, shared by every car
+            path: Path already calculated as node indices from pos to goal, None to calculate it
         """
         super().__init__(unique_id, model)
         self.goal = goal # The goal position of the car
         self.pos = pos # The current position of the car initialized where the car is spawned
-        self.patience = random.randint(patience, patience * 2) # The patience of the car
-        self.map = init_model # The map of the city in order to calculate the shortest path
-        self.path = [] # The path that the car will follow
+        self.patience = self.random.randint(patience, patience * 2) # The patience of the car
+        self.router = router # The shared routing engine of the city in order to calculate the shortest path
+        self.penalties = None # Extra weight this car adds to the edges (by edge id) of the shared map, created the first time it gets stuck
+        self.cursor = self.end = 0 # The path that the car will follow, empty for now
         self.dir = " " # The direction of the car
+        self.spawn_step = model.step_count # The step when the car was created, to know how long its trip took
+        self.baseline = 0 # Lowest congestion seen ahead since the path was calculated (see CongestionField.congested)
     
-        self.calculate_A_star(self.pos, self.goal) # Shortest path from spwawn to goal
+        if path is not None: # Given by the demand (see demand.Demand.route)
+            self.set_path(path)
+        else:
+            self.calculate_A_star(self.pos, self.goal, model.congestion.costs if model.congestion is not None else None) # Shortest path from spwawn to goal
                 
-    def calculate_A_star(self, pos, dest): 
+    def calculate_A_star(self, pos, dest, congestion = None): 
         """ 
         Calculate the shortest path from pos to dest using A* algorithm
+        Args:
+            congestion: Extra weight of each node (CongestionField.costs) to route around the traffic, or None
         """       
-        try:            
-            path = nx.shortest_path(self.map, pos, dest, weight='weight') # Calculate the shortest path
-            path = path[::-1] #reverse the path
-            # path.pop() # Remove the first element of the path
-            self.path = path # Set the path
-            
-            return []
-        except nx.NodeNotFound:
+        metrics = self.model.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        index = self.router.index
+        path = None
+        if pos in index and dest in index: # Read from the tree of dest, or A* if the car has penalties
+            tolerance = self.model.congestion.tolerance if congestion is not None else 0.0
+            path = self.router.path_indices(index[pos], index[dest], self.penalties, congestion, tolerance)
+        if metrics is not None:
+            metrics.add("route", start)
+            metrics.count("routes")
+            if path is not None:
+                metrics.path_length.observe(len(path))
+        if path is None:
             print("Either the source or the destination node does not exist in the graph.")
             return []
+        self.set_path(path) # Set the path
         
+        return []
+
+    def set_path(self, path):
+        """
+        Stores a new path (node indices, from the current position) in the arena of the model
+        """
+        self.cursor, self.end = self.model.arena.append(path)
+        self.reset_baseline()
+
+    def path_nodes(self, limit = None):
+        """
+        Nodes of the path still to follow, the next one first, only the first limit of them if given
+        """
+        end = self.end if limit is None else min(self.cursor + limit, self.end)
+        return self.model.arena.data[self.cursor:end].tolist()
+
+    def reset_baseline(self):
+        """
+        Takes the congestion ahead on a new path as the one to compare with
+        """
+        field = self.model.congestion
+        if field is not None:
+            self.baseline = field.ahead(self.path_nodes(field.horizon))
+
+    def check_congestion(self, field):
+        """
+        Looks for another path if the congestion ahead grew too much since the path was calculated.
+        Returns whether it did.
+        """
+        ahead = field.ahead(self.path_nodes(field.horizon))
+        if not field.congested(ahead, self.baseline):
+            self.baseline = min(self.baseline, ahead)
+            return False
+        self.calculate_A_star(self.pos, self.goal, field.costs)
+        if self.cursor < self.end and self.model.arena.data[self.cursor] == self.router.index[self.pos]: # Do not lose a step on the current position
+            self.cursor += 1
+        return True
+
     def check_diagonal(self):
         """
         Checks if the car can move diagonally
@@ -52,64 +112,119 @@ class Car(Agent):
         
         dict = {"Up": (1, 0), "Down": (-1, 0), "Right": (0, -1), "Left": (0, 1)} # Dictionary to get the "right" if the car
         
-        all_neighbors = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False) # Get all the neighbors of the car
-        
-        for neighbor in all_neighbors: # For each neighbor
-            if self.pos[0] + dict[self.dir][0] == neighbor.pos[0] and self.pos[1] + dict[self.dir][1] == neighbor.pos[1]:
-                if isinstance(neighbor, Car) and self.path[-1][0] != self.pos[0] and self.path[-1][1] != self.pos[1]: # If the neighbor is a car and the car is not moving
-                    self.patience -= 1
-                    return True
+        x, y = self.pos[0] + dict[self.dir][0], self.pos[1] + dict[self.dir][1] # The cell to the "right" of the car
+        if 0 <= x < self.model.width and 0 <= y < self.model.height and self.model.occupancy[x, y]:
+            next_pos = self.router.position(int(self.model.arena.data[self.cursor]))
+            if next_pos[0] != self.pos[0] and next_pos[1] != self.pos[1]: # If the neighbor is a car and the car is not moving
+                self.patience -= 1
+                return True
         
-        else:
-            return False
+        return False
         
     def move(self): 
         """ 
         Determines if the agent can move in the direction that was chosen
         """      
-        if self.path == []: # If the path is empty
+        if self.cursor >= self.end: # If the path is empty
             return 
         
-        neighbors = self.model.grid.get_cell_list_contents(self.path[-1]) # Get the neighbors of the car
+        next_pos = self.router.position(int(self.model.arena.data[self.cursor]))
+        lattice = self.model.lattice
+        kind = lattice.cell_type[next_pos] # What is in the next cell, without looking at the agents
         
-        for agent in neighbors:
-            if isinstance(agent, Car) and self.unique_id != agent.unique_id: # If the neighbor is a car and the car is not moving
-                self.patience -= 1 # Decrease the patience
+        if kind == TRAFFIC_LIGHT: # If the next cell is a traffic light
+            if not self.model.traffic_lights[lattice.light_id[next_pos]].state:
                 return #do not move
-            elif isinstance(agent, Traffic_Light): # If the neighbor is a traffic light
-                if not agent.state:                    
-                    return #do not move
-            # elif (self.check_diagonal()):
-            #     return
-            elif isinstance(agent, Destination): # If the neighbor is a destination
-                self.model.schedule.remove(self) # Remove the car from the schedule
-                self.model.grid.remove_agent(self) # Remove the car from the grid
-                self.model.car_count -= 1         
-                self.model.arrived_cars += 1       
-                return
-            elif isinstance(agent, Road): # If the neighbor is a road
-                self.dir = agent.direction
+        elif kind == ROAD: # If the next cell is a road
+            self.dir = lattice.direction_names[lattice.direction[next_pos]]
+        
+        if self.model.occupancy[next_pos] and next_pos != self.pos: # If there is another car in the next cell
+            self.patience -= 1 # Decrease the patience
+            if self.model.metrics is not None:
+                self.model.metrics.count("blocked_moves")
+            if self.model.congestion is not None:
+                self.model.congestion.blocked.append(self.router.index[next_pos])
+            return #do not move
+        # if self.check_diagonal():
+        #     return
+        
+        if kind == DESTINATION: # If the next cell is a destination
+            self.model.schedule.remove(self) # Remove the car from the schedule
+            del self.model.cars[self.unique_id]
+            self.model.occupancy[self.pos] = False
+            self.model.grid.remove_agent(self) # Remove the car from the grid
+            self.model.car_count -= 1         
+            self.model.arrived_cars += 1       
+            self.model.total_travel_time += self.model.step_count - self.spawn_step
+            return
                  
-        self.model.grid.move_agent(self, self.path[-1]) # Move the car to the next position
-        self.path.pop() # Remove the last element of the path
+        self.model.occupancy[self.pos] = False
+        self.model.occupancy[next_pos] = True
+        self.model.grid.move_agent(self, next_pos) # Move the car to the next position
+        self.cursor += 1 # Go to the next node of the path
         
     def out_of_patience(self): 
-        edges = nx.edges(self.map, [self.pos]) # Get the edges of the current position of the car
-        for edge in edges:         
-            if edge[1] == self.path[-1]: # If the edge is the same as the next position of the car
-                self.map.edges[edge]['weight'] += 5 # Increase the weight of the edge
-                self.patience = random.randint(5, 10) # Reset the patience
+        edge = self.router.edge_between(self.router.index[self.pos], int(self.model.arena.data[self.cursor])) # The edge from the current position of the car to the next one
+        if edge != -1:
+            if self.penalties is None:
+                self.penalties = {}
+            self.penalties[edge] = self.penalties.get(edge, 0) + 5 # Increase the weight of the edge only for this car
+            self.patience = self.random.randint(5, 10) # Reset the patience
+            if self.repair_path():
+                return
         
-        self.calculate_A_star(self.pos, self.goal) # Calculate a new path
+        field = self.model.congestion
+        self.calculate_A_star(self.pos, self.goal, field.costs if field is not None else None) # Calculate a new path
+
+    def repair_path(self):
+        """
+        Goes around the penalized edge with a short detour that joins the current path again (see Router.detour).
+        Returns False if there is none, then the whole path has to be calculated again.
+        """
+        ahead = [self.router.index[self.pos]] + self.path_nodes(REPAIR_WINDOW) # The next nodes of the path
+        field = self.model.congestion
+        found = self.router.detour(ahead, self.penalties, congestion=field.costs if field is not None else None)
+        if found is None:
+            return False
+        detour, i = found
+        metrics = self.model.metrics
+        if metrics is not None:
+            metrics.count("repairs")
+        # Keep the path after the node where the detour joins it (ahead[i] is the node at cursor + i - 1) and add the detour
+        self.set_path(detour + self.model.arena.data[self.cursor + i:self.end].tolist())
+        return True
         
 
     def step(self):
         """ 
         Determines the new direction it will take, and then moves
         """
+        metrics = self.model.metrics
+        if metrics is not None:
+            return self.measured_step(metrics)
         if self.patience <= 0: # If the patience is 0
             self.out_of_patience() # Call the out_of_patience function
+        elif self.model.congestion is not None and self.cursor < self.end and self.model.congestion.due(self.model.step_count - self.spawn_step):
+            self.check_congestion(self.model.congestion) # Avoid the traffic ahead before getting stuck in it
+        self.move()
+
+    def measured_step(self, metrics):
+        """
+        Same as step, adding the time of rerouting and moving to the metrics of the model
+        """
+        if self.patience <= 0:
+            start = time.perf_counter()
+            self.out_of_patience()
+            metrics.add("reroute", start)
+            metrics.count("reroutes")
+        elif self.model.congestion is not None and self.cursor < self.end and self.model.congestion.due(self.model.step_count - self.spawn_step):
+            start = time.perf_counter()
+            if self.check_congestion(self.model.congestion):
+                metrics.count("congestion_reroutes")
+            metrics.add("reroute", start)
+        start = time.perf_counter()
         self.move()
+        metrics.add("move", start)
 
 class Traffic_Light(Agent):
     """
@@ -132,6 +247,8 @@ class Traffic_Light(Agent):
         """ 
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
         """
+        if not self.model.signals.self_timed: # The signal controller of the model sets the state
+            return
         if self.model.schedule.steps % self.timeToChange == 0: # If the time to change is reached
             self.state = not self.state
 
@@ -0,0 +1,157 @@
+# Headless batch runner for parameter sweeps of CityModel, without Flask or the visualization.
+# Run from the model directory, for example:
+#   python batch_run.py --diagonales 1 1.5 2 --paciencia 1 5 --semaforos 1 5 --seeds 0-19 \
+#       --maps city_files/2022_base.txt city_files/2023_base.txt --steps 200 500 --out sweep.csv
+# To compare the traffic light policies (see signals.py):
+#   python batch_run.py --signals legacy fixed actuated max_pressure --seeds 0-19 --steps 600 --out signals.csv
+# Every run is written to the results file as soon as it finishes. Running the same command again
+# with the same --out file skips the runs that are already there, so an interrupted sweep continues.
+
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from model import CityModel
+
+# The sliders of server.py and the policy of the traffic lights, and the type of each one
+PARAMETERS = {"diagonales": float, "paciencia": int, "semaforos": float, "signals": str}
+
+KEY = ["map_file", "diagonales", "paciencia", "semaforos", "signals", "seed", "engine", "steps"] # One run
+COLUMNS = KEY + ["arrived_cars", "total_cars", "cars_alive", "throughput", "mean_travel_time", "mean_queue", "phase_switches", "wall_time"]
+
+
+def simulate(map_file, params, seed, engine, steps):
+    """
+    Runs one model up to the largest step count.
+    Returns a row of metrics for each of the step counts, so longer runs reuse the shorter ones.
+    """
+    rows = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # Cars print a line when they have no path to their destination
+        model = CityModel(map_file=map_file, seed=seed, engine=engine, **params)
+        for step in range(1, max(steps) + 1):
+            model.step()
+            if step in steps:
+                rows.append({
+                    "map_file": map_file, **params, "seed": seed, "engine": engine, "steps": step,
+                    "arrived_cars": model.arrived_cars,
+                    "total_cars": model.total_cars,
+                    "cars_alive": model.car_count,
+                    "throughput": model.arrived_cars / step, # Arrived cars per step
+                    "mean_travel_time": model.total_travel_time / model.arrived_cars if model.arrived_cars else "",
+                    "mean_queue": model.signals.queued / step, # Cars waiting before the traffic lights per step
+                    "phase_switches": "" if model.signals.self_timed else model.signals.switches, # Legacy lights flip on their own
+                    "wall_time": time.perf_counter() - start,
+                })
+    return rows
+
+
+def run_key(row):
+    """
+    Identifies a run in the results file, everything is compared as the text written in the file
+    """
+    return tuple(str(row[column]) for column in KEY)
+
+
+def read_done(out):
+    """
+    Keys of the runs already in the results file. A line cut by an interruption is ignored.
+    """
+    done = set()
+    if not os.path.exists(out):
+        return done
+    with open(out, newline='') as results:
+        reader = csv.DictReader(results)
+        if reader.fieldnames and reader.fieldnames != COLUMNS: # Written by an older version, the rows would not line up
+            raise ValueError(f"{out} has other columns than {COLUMNS}, write the results to another file")
+        for row in reader:
+            if None not in row.values() and row.get("wall_time"): # Complete rows only
+                done.add(run_key(row))
+    return done
+
+
+def parse_seeds(values):
+    """
+    Seeds from the command line, each value is a number or an inclusive range like 0-99
+    """
+    seeds = []
+    for value in values:
+        first, _, last = value.partition("-")
+        seeds += list(range(int(first), int(last or first) + 1))
+    return seeds
+
+
+def run_sweep(out, maps, seeds, steps, grid = None, engine = "objects", workers = None):
+    """
+    Runs every combination of the parameter grid, seeds and maps on a pool of processes.
+    Args:
+        out: CSV file where the results are appended, one row per run and step count
+        maps: Map files to use
+        seeds: Seeds of the random generator of the model
+        steps: Step counts to record, every combination runs once up to the largest one
+        grid: Dictionary parameter name -> list of values, missing parameters keep the CityModel default
+        engine: "objects" or "array", see CityModel
+        workers: Number of processes, by default one per core
+    Returns the number of simulations that were run.
+    """
+    grid = grid or {}
+    names = list(grid)
+    steps = sorted(set(steps))
+    done = read_done(out)
+
+    pending = []
+    for map_file, values, seed in itertools.product(maps, itertools.product(*grid.values()), seeds):
+        params = dict(zip(names, values))
+        row = {"map_file": map_file, **{name: "" for name in PARAMETERS}, **params, "seed": seed, "engine": engine}
+        missing = [s for s in steps if run_key({**row, "steps": s}) not in done]
+        if missing:
+            pending.append((map_file, params, seed, engine, missing))
+
+    if not pending:
+        return 0
+
+    new_file = not os.path.exists(out) or os.path.getsize(out) == 0
+    with open(out, "a", newline='') as results:
+        if not new_file:
+            with open(out, "rb") as existing: # Do not glue the first row to a line cut by an interruption
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    results.write("\n")
+        writer = csv.DictWriter(results, fieldnames=COLUMNS, restval="")
+        if new_file:
+            writer.writeheader()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(simulate, *run) for run in pending]
+            for count, future in enumerate(as_completed(futures), 1):
+                writer.writerows(future.result())
+                results.flush()
+                print(f"[{count}/{len(pending)}] runs done", file=sys.stderr)
+
+    return len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parameter sweeps of the traffic simulation")
+    for name, kind in PARAMETERS.items():
+        parser.add_argument(f"--{name}", type=kind, nargs="+", help=f"Values of {name}")
+    parser.add_argument("--seeds", nargs="+", default=["0"], help="Seeds, numbers or ranges like 0-99")
+    parser.add_argument("--maps", nargs="+", default=["city_files/2023_base.txt"], help="Map files")
+    parser.add_argument("--steps", type=int, nargs="+", default=[500], help="Step counts to record")
+    parser.add_argument("--engine", choices=["objects", "array"], default="objects")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: one per core)")
+    parser.add_argument("--out", default="sweep.csv", help="Results file")
+    args = parser.parse_args()
+
+    grid = {name: getattr(args, name) for name in PARAMETERS if getattr(args, name)}
+    runs = run_sweep(args.out, args.maps, parse_seeds(args.seeds), args.steps, grid, args.engine, args.workers)
+    print(f"{runs} runs written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
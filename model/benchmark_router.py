@@ -0,0 +1,74 @@
+# Compares the compiled Router against networkx shortest paths on the city maps.
+# Run from the model directory: python benchmark_router.py
+
+import glob
+import random
+import time
+import networkx as nx
+from model import CityModel
+from router import Router
+
+
+def timed(function, queries):
+    """
+    Runs function over every query and returns (seconds, results)
+    """
+    start = time.perf_counter()
+    results = [function(*query) for query in queries]
+    return time.perf_counter() - start, results
+
+
+def bench_map(map_file, queries_count=2000, seed=0):
+    """
+    Benchmarks one map: plain paths (destination trees) and paths with penalties (A*)
+    """
+    model = CityModel(map_file=map_file)
+    graph, router = model.map, model.router
+    rng = random.Random(seed)
+    nodes = list(graph.nodes)
+    queries = [(rng.choice(nodes), rng.choice(model.destinations)) for _ in range(queries_count)]
+    queries = [(s, d) for s, d in queries if nx.has_path(graph, s, d)]
+
+    # A few penalized edges per query, like a car that ran out of patience
+    edges = list(graph.edges)
+    penalized = [{e: 5 * rng.randint(1, 3) for e in rng.sample(edges, 3)} for _ in queries]
+
+    def nx_plain(s, d):
+        return nx.shortest_path(graph, s, d, weight='weight')
+
+    def nx_penalized(s, d, penalties):
+        return nx.shortest_path(graph, s, d, weight=lambda u, v, data: data['weight'] + penalties.get((u, v), 0))
+
+    def router_penalized(s, d, penalties):
+        return router.shortest_path(s, d, penalties)
+
+    start = time.perf_counter()
+    router = Router.from_graph(graph) # Compile again from scratch to time it
+    router.precompute(model.destinations)
+    compile_time = time.perf_counter() - start
+
+    nx_time, nx_paths = timed(nx_plain, queries)
+    tree_time, tree_paths = timed(router.shortest_path, queries)
+    with_penalties = [(s, d, p) for (s, d), p in zip(queries, penalized)]
+    nx_pen_time, nx_pen_paths = timed(nx_penalized, with_penalties)
+    by_edge_id = [(s, d, {router.edge_id(u, v): w for (u, v), w in p.items()}) for s, d, p in with_penalties] # Cars keep them by edge id
+    astar_time, astar_paths = timed(router_penalized, by_edge_id)
+
+    # Equal cost paths can differ, so compare the costs
+    def cost(path, penalties={}):
+        return sum(graph.edges[u, v]['weight'] + penalties.get((u, v), 0) for u, v in zip(path, path[1:]))
+    mismatches = sum(abs(cost(a) - cost(b)) > 1e-9 for a, b in zip(nx_paths, tree_paths))
+    mismatches += sum(abs(cost(a, p) - cost(b, p)) > 1e-9 for a, b, p in zip(nx_pen_paths, astar_paths, penalized))
+
+    n = len(queries)
+    print(f"{map_file}: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, {n} queries")
+    print(f"  compile + {len(model.destinations)} destination trees: {compile_time * 1e3:8.2f} ms")
+    print(f"  no penalties   networkx {nx_time / n * 1e6:8.1f} us/path   router tree {tree_time / n * 1e6:8.1f} us/path   x{nx_time / tree_time:.1f}")
+    print(f"  with penalties networkx {nx_pen_time / n * 1e6:8.1f} us/path   router A*   {astar_time / n * 1e6:8.1f} us/path   x{nx_pen_time / astar_time:.1f}")
+    print(f"  paths with a different cost: {mismatches}")
+    return mismatches
+
+
+if __name__ == '__main__':
+    for map_file in sorted(glob.glob('city_files/*_base.txt')):
+        bench_map(map_file)
@@ -0,0 +1,146 @@
+# Measures how CityModel scales with the size of the city and the number of cars, on maps made by city_generator.py.
+# Run from the model directory: python benchmark_scaling.py
+# Every case runs in its own process and is appended to the results file (benchmark_results.jsonl) with the
+# git revision, then compared with the last run of the same case on another revision, so regressions show up.
+#   python benchmark_scaling.py --blocks 2 4 8 16 32 --steps 900 --engines objects array
+# --demand RATE spawns RATE cars per step from every road cell on the border of the map (see demand.py)
+# instead of one car per corner every 3 steps, for load tests.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from city_generator import generate, save
+
+# Measures compared between revisions, and whether a larger value is better
+COMPARED = {"compile_seconds": False, "init_seconds": False, "step_ms": False, "arrivals_per_second": True, "peak_rss_mb": False}
+
+
+def revision():
+    """
+    Short hash of the checked out commit, with "+" if there are uncommitted changes
+    """
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return head + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def map_for(blocks, seed = 0):
+    """
+    Generated map with blocks x blocks blocks, written once to city_files/generated
+    """
+    path = f"city_files/generated/bench_{blocks}x{blocks}_s{seed}.txt"
+    if not os.path.exists(path):
+        save(generate(blocks, blocks, seed=seed), path)
+    return path
+
+
+def run_case(map_file, engine, steps, window, seed, demand = None):
+    """
+    Runs one case, in a process of its own so the memory of one case does not count in the next one.
+    Returns a dictionary with the measures, see main.
+    """
+    import city_map
+    from model import CityModel
+
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    city_map.compile_map(map_file, 1.5, 5, cache_dir=None) # Parse the map and build the graph and the trees
+    compile_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    model = CityModel(map_file=map_file, engine=engine, seed=seed, # The compiled map is already in memory
+                      demand={"sources": "border", "rate": demand} if demand else None)
+    init_seconds = time.perf_counter() - start
+
+    curve = [] # Latency of the steps of each window as the number of cars grows
+    total = 0.0
+    for first in range(0, steps, window):
+        start = time.perf_counter()
+        for _ in range(min(window, steps - first)):
+            model.step()
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        curve.append({"step": model.step_count, "cars_alive": model.car_count, "step_ms": elapsed / min(window, steps - first) * 1e3})
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Kilobytes on Linux
+    return {
+        "width": model.width, "height": model.height, "nodes": len(model.router.nodes), "destinations": len(model.destinations),
+        "compile_seconds": compile_seconds,
+        "init_seconds": init_seconds,
+        "step_ms": total / steps * 1e3,
+        "arrived_cars": model.arrived_cars,
+        "arrivals_per_second": model.arrived_cars / total if total else 0.0,
+        "peak_rss_mb": peak_rss / 1024,
+        "model_rss_mb": (peak_rss - base_rss) / 1024,
+        "curve": curve,
+    }
+
+
+def previous_results(out, rev):
+    """
+    Last result of each case in the results file from a revision other than rev
+    """
+    previous = {}
+    if not os.path.exists(out):
+        return previous
+    with open(out) as results:
+        for line in results:
+            try:
+                row = json.loads(line)
+            except ValueError: # A line cut by an interruption
+                continue
+            if row.get("revision") != rev:
+                previous[row["case"]] = row
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the traffic simulation")
+    parser.add_argument("--blocks", type=int, nargs="+", default=[2, 4, 8, 16], help="Blocks per side of each generated map")
+    parser.add_argument("--maps", nargs="*", default=[], help="Map files to run besides the generated ones")
+    parser.add_argument("--engines", nargs="+", choices=["objects", "array"], default=["objects", "array"])
+    parser.add_argument("--steps", type=int, default=600, help="Steps of each run, cars keep arriving so later steps have more cars")
+    parser.add_argument("--window", type=int, default=100, help="Steps per point of the latency curve")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--demand", type=float, default=None, help="Cars per step from the border of the map, by default one per corner every 3 steps")
+    parser.add_argument("--out", default="benchmark_results.jsonl", help="Results file, one JSON line per case")
+    args = parser.parse_args()
+
+    rev = revision()
+    previous = previous_results(args.out, rev)
+    maps = [map_for(blocks, args.seed) for blocks in args.blocks] + args.maps
+
+    with open(args.out, "a") as results:
+        for map_file in maps:
+            for engine in args.engines:
+                case = f"{os.path.basename(map_file)} {engine} {args.steps} steps seed {args.seed}" + (f" demand {args.demand}" if args.demand else "")
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    measures = pool.submit(run_case, map_file, engine, args.steps, args.window, args.seed, args.demand).result()
+                row = {"case": case, "revision": rev, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(), "map_file": map_file, "engine": engine, "steps": args.steps, **measures}
+                results.write(json.dumps(row) + "\n")
+                results.flush()
+
+                print(f"{case}: {row['width']} x {row['height']}, {row['nodes']} nodes, {row['destinations']} destinations")
+                old = previous.get(case)
+                for name, larger_is_better in COMPARED.items():
+                    line = f"  {name:20} {row[name]:12.4f}"
+                    if old is not None and old.get(name):
+                        ratio = row[name] / old[name]
+                        worse = ratio < 0.9 if larger_is_better else ratio > 1.1
+                        line += f"   x{ratio:5.2f} vs {old['revision']}" + ("   <- worse" if worse else "")
+                    print(line)
+                print("  cars alive / ms per step: " + ", ".join(f"{p['cars_alive']}/{p['step_ms']:.2f}" for p in row["curve"]))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
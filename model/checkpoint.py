@@ -0,0 +1,342 @@
+"""
+Checkpoints of a CityModel, taken between two steps: the random generator, the cars with their paths,
+patience and penalties, the traffic lights and their controller, the congestion field, the demand with
+its queues and the counters, in a compressed .npz. A model restored from a checkpoint takes exactly the same steps as the original
+one would have, so a warmed up state can be forked into many runs without replaying it.
+
+Cars are saved the same way for both engines, a checkpoint of an "objects" model can be restored
+with the "array" engine and the other way around.
+"""
+import io
+import json
+import math
+import os
+import zipfile
+import numpy as np
+from agent import Car
+from city_map import compile_map
+from engine import ArrayEngine
+from path_arena import PathArena
+from model import CityModel
+from signals import POLICIES
+from demand import Demand
+
+FORMAT = 1 # Change it when the content of the checkpoints changes, the old ones are not read anymore
+
+MAP_DIR = "city_files" # Checkpoints can only name map files in this directory
+
+# Arrays every checkpoint has, and the ones of a model with a demand
+REQUIRED = ["map_file", "map_key", "diagonales", "paciencia", "semaforos", "engine", "congestion", "signals", "static_agents", "metrics",
+            "counters", "rng_version", "rng_words", "rng_gauss", "light_state", "signal_current", "signal_elapsed", "signal_state",
+            "signal_counters", "car_number", "car_node", "car_goal", "car_patience", "car_spawn_step", "car_baseline",
+            "path_start", "path_nodes", "penalty_start", "penalty_edges", "penalty_values"]
+DEMAND = ["demand_sources", "demand_sinks", "demand_matrix", "demand_profile", "demand_settings", "demand_queue_start", "demand_queue", "demand_rng"]
+
+# Parameters of CityModel that can be changed when a checkpoint is restored, for what-if runs
+OVERRIDES = ["paciencia", "engine", "signals", "congestion", "static_agents", "metrics"]
+
+
+def checkpoint(model):
+    """
+    Bytes of a checkpoint of a model. It must not be stepping.
+    """
+    signals = next((name for name, policy in POLICIES.items() if type(model.signals) is policy), None)
+    if signals is None:
+        raise ValueError(f"Only the signal policies of signals.POLICIES can be saved, not {type(model.signals).__name__}")
+    version, words, gauss = model.random.getstate()
+    cars = cars_of(model)
+
+    arrays = {
+        "format": FORMAT,
+        "map_file": model.map_file, "map_key": model.city.key,
+        "diagonales": model.diagonales, "paciencia": model.paciencia, "semaforos": model.semaforos,
+        "engine": "array" if model.engine is not None else "objects",
+        "congestion": model.congestion.weight if model.congestion is not None else 0.0,
+        "signals": signals, "static_agents": model.static_agents, "metrics": model.metrics is not None,
+        # step_count, car_count, total_cars, arrived_cars, total_travel_time, schedule.steps, schedule.time, running
+        "counters": np.array([model.step_count, model.car_count, model.total_cars, model.arrived_cars, model.total_travel_time,
+                              model.schedule.steps, model.schedule.time, model.running], dtype=np.int64),
+        "rng_version": version, "rng_words": np.array(words, dtype=np.uint32),
+        "rng_gauss": np.nan if gauss is None else gauss,
+        "light_state": np.array([light.state for light in model.traffic_lights], dtype=bool),
+        "signal_current": model.signals.current, "signal_elapsed": model.signals.elapsed,
+        "signal_state": model.signals.state, "signal_counters": np.array([model.signals.queued, model.signals.switches], dtype=np.int64),
+        **cars,
+    }
+    if model.congestion is not None:
+        arrays["congestion_level"] = model.congestion.level
+    demand = model.demand
+    if demand is not None:
+        arrays.update({
+            "demand_sources": np.array(demand.sources, dtype=np.int32).reshape(-1, 2),
+            "demand_sinks": np.array(demand.sinks, dtype=np.int32).reshape(-1, 2),
+            "demand_matrix": demand.matrix, "demand_profile": demand.profile,
+            "demand_settings": np.array([demand.period, demand.max_queue, demand.dropped], dtype=np.int64),
+            "demand_queue_start": np.cumsum([0] + [len(queue) for queue in demand.queues], dtype=np.int64),
+            "demand_queue": np.array([sink for queue in demand.queues for sink in queue], dtype=np.int32),
+            "demand_rng": json.dumps(demand.rng.bit_generator.state),
+        })
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def restore(data, **overrides):
+    """
+    New CityModel from the bytes of a checkpoint.
+    Args:
+        data: Bytes returned by checkpoint
+        overrides: New values of the parameters in OVERRIDES, the others are always the ones of the checkpoint
+    Raises ValueError if the checkpoint can not be read, it is from another format, its map is not a file of MAP_DIR,
+    the map changed since or any of its values does not fit the model, a checkpoint can come from anywhere.
+    """
+    unknown = set(overrides) - set(OVERRIDES)
+    if unknown:
+        raise ValueError(f"These parameters can not change when restoring: {sorted(unknown)}")
+    try:
+        saved = dict(np.load(io.BytesIO(data), allow_pickle=False))
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        raise ValueError("Not a checkpoint")
+    if int(saved.get("format", -1)) != FORMAT:
+        raise ValueError("The checkpoint is from another version of the model")
+    missing = [name for name in REQUIRED + (DEMAND if "demand_matrix" in saved else []) if name not in saved]
+    if missing:
+        raise ValueError(f"The checkpoint is missing {missing}")
+
+    try:
+        params = {"map_file": str(saved["map_file"]), "diagonales": float(saved["diagonales"]), "paciencia": int(saved["paciencia"]),
+                  "semaforos": float(saved["semaforos"]), "engine": str(saved["engine"]), "congestion": float(saved["congestion"]),
+                  "signals": str(saved["signals"]), "static_agents": bool(saved["static_agents"]), "metrics": bool(saved["metrics"])}
+    except (TypeError, ValueError):
+        raise ValueError("The checkpoint has parameters of the wrong type")
+    check_params(params)
+    check_map(params["map_file"])
+    try:
+        key = compile_map(params["map_file"], params["diagonales"], params["semaforos"]).key
+    except OSError as error:
+        raise ValueError(f"{params['map_file']} can not be read: {error}")
+    if key != str(saved["map_key"]):
+        raise ValueError(f"{params['map_file']} changed since the checkpoint was taken")
+    same_signals = overrides.get("signals", params["signals"]) == params["signals"]
+    params.update(overrides)
+    check_params(params)
+
+    demand = None
+    if "demand_matrix" in saved:
+        settings = saved["demand_settings"].ravel().tolist()
+        if len(settings) != 3:
+            raise ValueError("The checkpoint has demand settings of the wrong size")
+        period, max_queue, dropped = settings
+        try:
+            demand = Demand(saved["demand_sources"].tolist(), saved["demand_sinks"].tolist(), saved["demand_matrix"], saved["demand_profile"], period, max_queue)
+        except TypeError:
+            raise ValueError("The checkpoint has a demand of the wrong type")
+    model = CityModel(**params, demand=demand) # Raises ValueError if the demand is not on the map
+    check_saved(model, saved, same_signals)
+
+    clear_cars(model)
+    try:
+        add_saved_cars(model, saved) # Before the congestion field, so the new cars get free-flow paths that are then replaced
+    except (IndexError, TypeError, ValueError):
+        raise ValueError("The cars of the checkpoint are not on its map")
+
+    (model.step_count, model.car_count, model.total_cars, model.arrived_cars, model.total_travel_time,
+     model.schedule.steps, model.schedule.time, running) = saved["counters"].tolist()
+    model.running = bool(running)
+    if model.congestion is not None and "congestion_level" in saved:
+        model.congestion.set_level(saved["congestion_level"])
+
+    signals = model.signals
+    signals.queued, signals.switches = saved["signal_counters"].tolist()
+    if same_signals:
+        signals.current, signals.elapsed, signals.state = saved["signal_current"], saved["signal_elapsed"], saved["signal_state"]
+    # Legacy lights or the ones the saved controller had set, otherwise the ones a new controller starts with
+    state = saved["light_state"] if signals.self_timed or same_signals else signals.state
+    for light, green in zip(model.traffic_lights, state.tolist()):
+        light.state = green
+    if model.engine is not None:
+        model.engine.light_state[:] = state
+
+    if demand is not None:
+        start = saved["demand_queue_start"].tolist()
+        queue = saved["demand_queue"].tolist()
+        for s, waiting in enumerate(demand.queues):
+            waiting.extend(queue[start[s]:start[s + 1]])
+        demand.dropped = dropped
+        try:
+            demand.rng.bit_generator.state = json.loads(str(saved["demand_rng"]))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("The checkpoint has a demand generator of the wrong type")
+
+    gauss = float(saved["rng_gauss"])
+    try:
+        model.random.setstate((int(saved["rng_version"]), tuple(saved["rng_words"].tolist()), None if np.isnan(gauss) else gauss))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("The checkpoint has a random generator of the wrong type")
+    return model
+
+
+def check_params(params):
+    """
+    Raises ValueError unless the parameters of a checkpoint are ones CityModel can run with, like /init checks them.
+    Negative weights would make the shortest path trees of compile_map never end.
+    """
+    for name in ["diagonales", "semaforos"]:
+        if not math.isfinite(params[name]) or params[name] <= 0:
+            raise ValueError(f"Invalid value for {name} in the checkpoint: {params[name]}")
+    if params["paciencia"] < 0:
+        raise ValueError(f"Invalid value for paciencia in the checkpoint: {params['paciencia']}")
+    if not math.isfinite(params["congestion"]) or params["congestion"] < 0:
+        raise ValueError(f"Invalid value for congestion in the checkpoint: {params['congestion']}")
+    if params["engine"] not in ["objects", "array"]:
+        raise ValueError(f"Unknown engine in the checkpoint: {params['engine']}")
+    if params["signals"] not in POLICIES:
+        raise ValueError(f"Unknown signals policy in the checkpoint: {params['signals']}")
+
+
+def check_saved(model, saved, same_signals):
+    """
+    Raises ValueError unless the arrays of a checkpoint have the sizes and values of the new model they are restored into
+    """
+    def expect(name, size):
+        if saved[name].ndim != 1 or len(saved[name]) != size:
+            raise ValueError(f"The checkpoint has {name} of the wrong size")
+
+    cars = len(saved["car_number"])
+    for name in ["car_number", "car_node", "car_goal", "car_patience", "car_spawn_step", "car_baseline"]:
+        expect(name, cars)
+    expect("path_start", cars + 1)
+    expect("penalty_start", cars + 1)
+    expect("penalty_values", len(saved["penalty_edges"]))
+    nodes = len(model.router.nodes)
+    for name in ["car_node", "car_goal", "path_nodes"]:
+        if len(saved[name]) and (saved[name].min() < 0 or saved[name].max() >= nodes):
+            raise ValueError(f"The checkpoint has {name} that are not nodes of its map")
+    for name, values in [("path_start", saved["path_nodes"]), ("penalty_start", saved["penalty_edges"])]:
+        start = saved[name]
+        if start[0] != 0 or (np.diff(start) < 0).any() or start[-1] != len(values):
+            raise ValueError(f"The checkpoint has {name} of the wrong size")
+    expect("counters", 8)
+    expect("signal_counters", 2)
+    expect("light_state", len(model.traffic_lights))
+    if model.congestion is not None and "congestion_level" in saved:
+        expect("congestion_level", len(model.router.nodes))
+    signals = model.signals
+    if same_signals:
+        expect("signal_current", len(signals.current))
+        expect("signal_elapsed", len(signals.elapsed))
+        expect("signal_state", len(signals.state))
+        current = saved["signal_current"]
+        if ((current < 0) | (current >= len(signals.phase_group))).any() or \
+                (signals.phase_intersection[current] != np.arange(len(current))).any():
+            raise ValueError("The checkpoint has phases of the traffic lights that are not of their intersection")
+    demand = model.demand
+    if demand is not None:
+        expect("demand_queue_start", len(demand.sources) + 1)
+        start, queue = saved["demand_queue_start"], saved["demand_queue"]
+        if start[0] != 0 or (np.diff(start) < 0).any() or start[-1] != len(queue):
+            raise ValueError("The checkpoint has demand queues of the wrong size")
+        if len(queue) and (queue.min() < 0 or queue.max() >= len(demand.sinks)):
+            raise ValueError("The checkpoint has demand queues with unknown sinks")
+
+
+def check_map(map_file):
+    """
+    Raises ValueError unless the map file is a file in MAP_DIR, a checkpoint can come from anywhere
+    """
+    root = os.path.realpath(MAP_DIR)
+    path = os.path.realpath(map_file)
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        raise ValueError(f"{map_file} is not a map file of {MAP_DIR}")
+
+
+def cars_of(model):
+    """
+    Arrays with the cars of a model in the order they were spawned, the same for both engines.
+    Paths are the nodes still to visit, the current one first while the car has not moved on its path.
+    """
+    router = model.router
+    number, node, goal, patience, spawn_step, baseline = [], [], [], [], [], []
+    paths, penalties = [], []
+    if model.engine is not None:
+        engine = model.engine
+        live = engine.live.tolist()
+        number, node, goal = engine.number[live], engine.node[live], engine.goal[live]
+        patience, spawn_step, baseline = engine.patience[live], engine.spawn_step[live], engine.baseline[live]
+        paths = [engine.arena.data[engine.cursor[slot]:engine.end[slot]] for slot in live]
+        penalties = [engine.penalties[slot] or {} for slot in live]
+    else:
+        for car in model.cars.values():
+            number.append(int(car.unique_id[2:]))
+            node.append(router.index[car.pos])
+            goal.append(router.index[car.goal])
+            patience.append(car.patience)
+            spawn_step.append(car.spawn_step)
+            baseline.append(car.baseline)
+            paths.append(car.path_nodes())
+            penalties.append(car.penalties or {})
+
+    lengths = [len(path) for path in paths]
+    return {
+        "car_number": np.asarray(number, dtype=np.int64), "car_node": np.asarray(node, dtype=np.int32),
+        "car_goal": np.asarray(goal, dtype=np.int32), "car_patience": np.asarray(patience, dtype=np.int32),
+        "car_spawn_step": np.asarray(spawn_step, dtype=np.int64), "car_baseline": np.asarray(baseline, dtype=np.int64),
+        # Paths and penalties of all the cars one after the other, with the offset where each car starts
+        "path_start": np.cumsum([0] + lengths, dtype=np.int64),
+        "path_nodes": np.concatenate([np.asarray(path, dtype=np.int32) for path in paths] + [np.zeros(0, dtype=np.int32)]),
+        "penalty_start": np.cumsum([0] + [len(p) for p in penalties], dtype=np.int64),
+        "penalty_edges": np.array([edge for p in penalties for edge in p], dtype=np.int64),
+        "penalty_values": np.array([value for p in penalties for value in p.values()], dtype=np.float64),
+    }
+
+
+def clear_cars(model):
+    """
+    Removes the cars a new model spawns when it is created
+    """
+    model.arena = PathArena()
+    if model.engine is not None:
+        model.engine = ArrayEngine(model)
+        return
+    for car in model.cars.values():
+        model.schedule.remove(car)
+        model.grid.remove_agent(car)
+    model.cars = {}
+    model.occupancy[:] = False
+
+
+def add_saved_cars(model, saved):
+    """
+    Adds the cars of a checkpoint to a model without cars, in the order they were spawned
+    """
+    nodes = model.router.nodes
+    path_start, penalty_start = saved["path_start"].tolist(), saved["penalty_start"].tolist()
+    edges, values = saved["penalty_edges"].tolist(), saved["penalty_values"].tolist()
+    for i, (number, node, goal, patience, spawn_step, baseline) in enumerate(zip(
+            saved["car_number"].tolist(), saved["car_node"].tolist(), saved["car_goal"].tolist(),
+            saved["car_patience"].tolist(), saved["car_spawn_step"].tolist(), saved["car_baseline"].tolist())):
+        path = saved["path_nodes"][path_start[i]:path_start[i + 1]].tolist()
+        penalties = dict(zip(edges[penalty_start[i]:penalty_start[i + 1]], values[penalty_start[i]:penalty_start[i + 1]])) or None
+        pos, goal_pos = tuple(nodes[node].tolist()), tuple(nodes[goal].tolist())
+
+        if model.engine is not None:
+            engine = model.engine
+            engine.add_car(number, pos, goal_pos, patience)
+            slot = int(engine.live[-1])
+            engine.cursor[slot], engine.end[slot] = engine.arena.append(path)
+            engine.spawn_step[slot] = spawn_step
+            engine.baseline[slot] = baseline
+            engine.penalties[slot] = penalties
+            continue
+
+        car = Car(f"c_{number}", model, goal_pos, model.router, pos, model.paciencia)
+        car.set_path(path)
+        car.patience = patience
+        car.spawn_step = spawn_step
+        car.baseline = baseline
+        car.penalties = penalties
+        model.grid.place_agent(car, pos)
+        model.occupancy[pos] = True
+        model.schedule.add(car)
+        model.cars[car.unique_id] = car
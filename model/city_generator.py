@@ -0,0 +1,133 @@
+# Generates city maps of any size in the format of city_files/*_base.txt, for benchmarks on large cities.
+# Run from the model directory, for example:
+#   python city_generator.py --blocks 20 20 --block-size 6 4 --seed 0 --out city_files/generated/city_20x20.txt
+# The city is a grid of blocks with two lane one-way streets between them, inside a two lane ring road
+# going counterclockwise like the base maps. Streets alternate their direction, some of them get traffic
+# lights before the crossings and some blocks get destinations next to a street.
+
+import argparse
+import os
+import random
+import numpy as np
+from city_map import build_lines
+
+# Corners of the ring road, as rows of the file (top first)
+CORNERS = {
+    "top_left": ["v<", "v<"],
+    "top_right": ["<<", "<^"],
+    "bottom_left": ["v>", ">>"],
+    "bottom_right": ["^^", ">^"],
+}
+
+
+def generate(blocks_x, blocks_y, block_w = 6, block_h = 4, lights = 0.5, destinations = 0.5, seed = 0):
+    """
+    Lines of a new map file.
+    Args:
+        blocks_x, blocks_y: Number of blocks in each direction
+        block_w, block_h: Size of each block, at least 3 x 3 so there is room for a traffic light before each crossing
+        lights: Chance of a traffic light before each crossing of two inner streets
+        destinations: Chance of a destination in each block
+        seed: Seed of the random choices
+    """
+    if block_w < 3 or block_h < 3:
+        raise ValueError("Blocks must be at least 3 x 3")
+    rng = random.Random(seed)
+    width = 4 + blocks_x * block_w + (blocks_x - 1) * 2
+    height = 4 + blocks_y * block_h + (blocks_y - 1) * 2
+    rows = [["#"] * width for _ in range(height)] # rows[r][c], r = 0 is the top line of the file
+
+    # First column and row of each inner street, and of each block
+    street_cols = [2 + block_w + i * (block_w + 2) for i in range(blocks_x - 1)]
+    street_rows = [2 + block_h + i * (block_h + 2) for i in range(blocks_y - 1)]
+    block_cols = [2 + i * (block_w + 2) for i in range(blocks_x)]
+    block_rows = [2 + i * (block_h + 2) for i in range(blocks_y)]
+
+    # Horizontal streets first, the vertical ones go over them at the crossings like in the base maps
+    for i, r in enumerate(street_rows):
+        for c in range(2, width - 2):
+            rows[r][c] = rows[r + 1][c] = "<" if i % 2 == 0 else ">"
+    for i, c in enumerate(street_cols):
+        for r in range(2, height - 2):
+            rows[r][c] = rows[r][c + 1] = "v" if i % 2 == 0 else "^"
+
+    # Traffic lights on both lanes, one cell before the crossing in the direction of the street
+    for i, r in enumerate(street_rows):
+        step = -1 if i % 2 == 0 else 1 # "<" goes to lower columns
+        for c in street_cols:
+            if rng.random() < lights:
+                light = c + 2 if step == -1 else c - 1
+                rows[r][light] = rows[r + 1][light] = "s"
+    for i, c in enumerate(street_cols):
+        step = 1 if i % 2 == 0 else -1 # "v" goes to lower lines of the map, higher rows of the file
+        for r in street_rows:
+            if rng.random() < lights:
+                light = r - 1 if step == 1 else r + 2
+                rows[light][c] = rows[light][c + 1] = "S"
+
+    # Destinations on the border of the blocks, next to a street
+    for top in block_rows:
+        for left in block_cols:
+            if rng.random() < destinations:
+                border = [(top, c) for c in range(left, left + block_w)] + [(top + block_h - 1, c) for c in range(left, left + block_w)]
+                border += [(r, left) for r in range(top + 1, top + block_h - 1)] + [(r, left + block_w - 1) for r in range(top + 1, top + block_h - 1)]
+                r, c = rng.choice(border)
+                rows[r][c] = "D"
+
+    # Ring road
+    for r in range(height):
+        rows[r][0] = rows[r][1] = "v"
+        rows[r][width - 2] = rows[r][width - 1] = "^"
+    for c in range(width):
+        rows[0][c] = rows[1][c] = "<"
+        rows[height - 2][c] = rows[height - 1][c] = ">"
+    for corner, lines in CORNERS.items():
+        top = 0 if corner.startswith("top") else height - 2
+        left = 0 if corner.endswith("left") else width - 2
+        for dr, line in enumerate(lines):
+            rows[top + dr][left:left + 2] = list(line)
+
+    return ["".join(row) + "\n" for row in rows]
+
+
+def unreachable(lines, diagonales = 1.5, semaforos = 5):
+    """
+    Destinations of a map that some spawn point can not get to
+    """
+    compiled = build_lines(None, lines, diagonales, semaforos)
+    router = compiled.router
+    missing = []
+    for dest in compiled.destinations:
+        dist = router.tree(router.index[dest])[0]
+        if any(pos not in router.index or not np.isfinite(dist[router.index[pos]]) for pos in compiled.spawn_points):
+            missing.append(dest)
+    return missing
+
+
+def save(lines, out):
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as file:
+        file.writelines(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a city map")
+    parser.add_argument("--blocks", type=int, nargs=2, default=[4, 4], metavar=("X", "Y"), help="Number of blocks")
+    parser.add_argument("--block-size", type=int, nargs=2, default=[6, 4], metavar=("W", "H"), help="Size of each block")
+    parser.add_argument("--lights", type=float, default=0.5, help="Chance of a traffic light before each crossing")
+    parser.add_argument("--destinations", type=float, default=0.5, help="Chance of a destination in each block")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="Map file to write (default: city_files/generated/city_XxY_sSEED.txt)")
+    args = parser.parse_args()
+
+    lines = generate(*args.blocks, *args.block_size, args.lights, args.destinations, args.seed)
+    missing = unreachable(lines)
+    if missing:
+        print(f"Warning: {len(missing)} destinations can not be reached from every spawn point: {missing}")
+    out = args.out or f"city_files/generated/city_{args.blocks[0]}x{args.blocks[1]}_s{args.seed}.txt"
+    save(lines, out)
+    print(f"{len(lines[0]) - 1} x {len(lines)} map written to {out}")
+
+
+if __name__ == '__main__':
+    main()
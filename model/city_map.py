@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+import numpy as np
+import networkx as nx
+from router import Router
+from lattice import Lattice, TRAFFIC_LIGHT
+
+DICTIONARY_FILE = "city_files/mapDictionary.json"
+CACHE_DIR = "city_files/.cache" # Compiled maps on disk, one .npz per map and weights
+FORMAT = 1 # Change it when the content of the .npz changes, the old files are not read anymore
+
+MEMORY_MAPS = 8 # Compiled maps kept in memory by a process, the one used longest ago goes first
+_compiled = OrderedDict() # Key -> CompiledMap already loaded by this process
+_compiled_lock = threading.Lock() # The server creates models from several threads
+
+
+class CompiledMap:
+    """
+    Everything CityModel needs from a map file and the weights of its graph, built once and shared
+    by every model that uses the same map.
+    Attributes:
+        key: Hash of the map file, the map dictionary and the weights
+        width, height: Size of the map
+        lattice: Static grids of the city (Lattice)
+        router: The graph compiled into arrays, with the shortest path tree of every destination (Router)
+        destinations: Positions of the destinations, in the order of the map file
+        spawn_points: The cells where cars appear
+        light_group: Group of each traffic light, the lights that touch each other form one intersection
+    """
+    def __init__(self, key, lattice, router, destinations, spawn_points, light_group):
+        self.key = key
+        self.lattice = lattice
+        self.router = router
+        self.width, self.height = lattice.width, lattice.height
+        self.destinations = destinations
+        self.spawn_points = spawn_points
+        self.light_group = light_group
+        self._graph = None
+
+    @property
+    def graph(self):
+        """
+        Frozen networkx DiGraph of the map, rebuilt from the router only when asked for (plots and benchmarks)
+        """
+        if self._graph is None:
+            router = self.router
+            graph = nx.DiGraph()
+            graph.add_nodes_from(map(tuple, router.nodes.tolist()))
+            for u, (start, end) in enumerate(zip(router._indptr, router._indptr[1:])):
+                for v, weight in zip(router._indices[start:end], router._weights[start:end]):
+                    graph.add_edge(tuple(router.nodes[u].tolist()), tuple(router.nodes[v].tolist()), weight=weight)
+            self._graph = nx.freeze(graph)
+        return self._graph
+
+    def save(self, path):
+        """
+        Writes the map to a .npz file, through a temporary file so a reader never sees half of it
+        """
+        router, lattice = self.router, self.lattice
+        targets = sorted(router.trees)
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file,
+                    cell_type=lattice.cell_type, direction=lattice.direction, light_id=lattice.light_id,
+                    light_time=lattice.light_time, light_state=lattice.light_state,
+                    direction_names=np.array([name or "" for name in lattice.direction_names]),
+                    nodes=router.nodes, indptr=router.indptr, indices=router.indices, weights=router.weights,
+                    tree_targets=np.array(targets, dtype=np.int32),
+                    tree_dist=np.array([router.trees[t][0] for t in targets]).reshape(len(targets), -1),
+                    tree_next=np.array([router.trees[t][1] for t in targets], dtype=np.int32).reshape(len(targets), -1),
+                    destinations=np.array(self.destinations, dtype=np.int32).reshape(-1, 2),
+                    spawn_points=np.array(self.spawn_points, dtype=np.int32).reshape(-1, 2),
+                    light_group=self.light_group)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    @classmethod
+    def load(cls, key, path):
+        """
+        Reads a map written by save
+        """
+        with np.load(path, allow_pickle=False) as data:
+            lattice = Lattice(data["cell_type"], data["direction"], data["light_id"], data["light_time"],
+                              data["light_state"], [name or None for name in data["direction_names"].tolist()])
+            router = Router(data["nodes"], data["indptr"], data["indices"], data["weights"])
+            router.add_trees(data["tree_targets"], data["tree_dist"], data["tree_next"])
+            return cls(key, lattice, router,
+                       list(map(tuple, data["destinations"].tolist())),
+                       list(map(tuple, data["spawn_points"].tolist())),
+                       data["light_group"])
+
+
+def map_key(map_file, diagonales, semaforos):
+    """
+    Hash of everything the compiled map depends on: the map file, the map dictionary and the weights
+    """
+    digest = hashlib.sha256(f"{FORMAT} {float(diagonales)!r} {float(semaforos)!r}".encode())
+    for path in [map_file, DICTIONARY_FILE]:
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:32]
+
+
+def compile_map(map_file, diagonales, semaforos, cache_dir = CACHE_DIR):
+    """
+    Compiled map of a map file, taken from memory, from the disk cache or built and saved to it.
+    Args:
+        map_file: Text file with the map of the city
+        diagonales: Weight of the diagonal edges
+        semaforos: Weight of the edges out of the traffic lights is semaforos * 5
+        cache_dir: Directory of the .npz files, None to not use the disk. Only the weights of the sliders use it (see on_sliders).
+    """
+    key = map_key(map_file, diagonales, semaforos)
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+            return compiled
+
+    path = os.path.join(cache_dir, f"{key}.npz") if cache_dir and on_sliders(diagonales, semaforos) else None
+    compiled = None
+    if path and os.path.exists(path):
+        try:
+            compiled = CompiledMap.load(key, path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile): # Broken file, build it again
+            compiled = None
+
+    if compiled is None:
+        compiled = build_map(key, map_file, diagonales, semaforos)
+        if path:
+            try:
+                compiled.save(path)
+            except OSError: # Read-only directory, keep it in memory only
+                pass
+
+    with _compiled_lock: # Not while building, a slow map does not hold up the others
+        compiled = _compiled.setdefault(key, compiled) # The first one if another thread built it at the same time
+        _compiled.move_to_end(key)
+        if len(_compiled) > MEMORY_MAPS:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def on_sliders(diagonales, semaforos):
+    """
+    Whether the weights are values of the sliders of server.py: diagonales from 0.5 to 5 by tenths and semaforos
+    a whole number from 1 to 40. Any other value is not saved to disk, so the values clients send can not fill it.
+    """
+    tenths = float(diagonales) * 10
+    return 5 <= tenths <= 50 and abs(tenths - round(tenths)) < 1e-9 and float(semaforos).is_integer() and 1 <= semaforos <= 40
+
+
+def build_map(key, map_file, diagonales, semaforos):
+    """
+    Parses a map file and builds its graph, the slow path of compile_map
+    """
+    with open(map_file) as baseFile:
+        lines = baseFile.readlines()
+    return build_lines(key, lines, diagonales, semaforos)
+
+
+def build_lines(key, lines, diagonales, semaforos):
+    """
+    Same as build_map, for the lines of a map that is not in a file (like a generated one)
+    """
+    with open(DICTIONARY_FILE) as file:
+        dataDictionary = json.load(file)
+    width = len(lines[0]) - 1 # The width of the map
+    height = len(lines) # The height of the map
+
+    destinations = []
+    graph = init_Graph(nx.DiGraph(), lines, height, destinations, diagonales, semaforos)
+    router = Router.from_graph(graph)
+    router.precompute(destinations) # Shortest path tree of every destination
+    lattice = Lattice.parse(lines, dataDictionary, width, height)
+    spawn_points = [(0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)]
+    compiled = CompiledMap(key, lattice, router, destinations, spawn_points, light_groups(lattice))
+    compiled._graph = nx.freeze(graph)
+    return compiled
+
+
+def light_groups(lattice):
+    """
+    Group of each traffic light: lights in neighboring cells (up, down, left or right) share a group.
+    Groups are numbered in the order of their first light.
+    """
+    group = np.full(len(lattice.light_pos), -1, dtype=np.int32)
+    count = 0
+    for first in range(len(group)):
+        if group[first] >= 0:
+            continue
+        group[first] = count
+        pending = [lattice.light_pos[first]]
+        while pending: # Flood fill over the light cells
+            x, y = pending.pop()
+            for pos in [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]:
+                if 0 <= pos[0] < lattice.width and 0 <= pos[1] < lattice.height and lattice.cell_type[pos] == TRAFFIC_LIGHT:
+                    light = lattice.light_id[pos]
+                    if group[light] < 0:
+                        group[light] = count
+                        pending.append(pos)
+        count += 1
+    return group
+
+
+def init_Graph(graph, lines, height, destinations, diagonales, semaforos):
+    """
+    Adds the roads, traffic lights and destinations of the map to the graph and connects them.
+    The destinations are appended to destinations, in the order of the map file.
+    """
+    for r, row in enumerate(lines): # r = row, c = column
+        for c, col in enumerate(row):
+            if col in ["v", "^", ">", "<"]: # If the character is a road
+                graph.add_node((c, height - r - 1), direction=col)  # Add direction as an attribute
+
+            elif col in ["S", "s"]: # If the character is a traffic light
+                # Add an attribute to mark "S" as "long" and "s" as "short"
+                graph.add_node((c, height - r - 1), direction=None, signal_type="long" if col == "S" else "short")
+
+            elif col == "D": # If the character is a destination
+                graph.add_node((c, height - r - 1), direction=None)  # No direction for destination
+                destinations.append((c, height - r - 1)) # Add destination pos to the list
+
+    for node in graph.nodes:
+        x, y = node
+
+        if graph.nodes[node]['direction'] == "^":
+            adding_edges(graph, node, x, y, 0, 1, [(x - 1, y + 1), (x + 1, y + 1), (x, y + 1), (x - 1 , y), (x + 1, y)], [">", "<"], diagonales, semaforos)
+            #adding_edges(graph, node, x, y, direccionY, direccionY, neighbors a conectar, caracteres especiales)
+
+        if graph.nodes[node]['direction'] == "v":
+            adding_edges(graph, node, x, y, 0, -1, [(x + 1, y - 1), (x - 1, y - 1),(x, y - 1), (x + 1, y), (x - 1, y)], ["<", ">"], diagonales, semaforos)
+
+        if graph.nodes[node]['direction'] == "<":
+            adding_edges(graph, node, x, y, -1, 0, [(x - 1, y - 1), (x - 1, y + 1), (x - 1, y), (x, y - 1), (x, y + 1)], ["^", "v"], diagonales, semaforos)
+
+        if graph.nodes[node]['direction'] == ">":
+            adding_edges(graph, node, x, y, 1, 0, [(x + 1, y - 1), (x + 1, y + 1), (x + 1, y), (x, y - 1), (x, y + 1)], ["^", "v"], diagonales, semaforos)
+
+    return graph
+
+
+def adding_edges(graph, node, x, y, xVal, yVal, neighbors, chars, diagonales, semaforos):
+    for neighbor in neighbors:
+        if neighbor in graph.nodes: # If the neighbor is in the graph
+            if graph.nodes[neighbor]['direction'] in chars and ( neighbor == neighbors[0] or neighbor == neighbors[1]):
+                # If the neighbor is a diagonal and is one of the special characters do not add an edge
+                continue
+            elif (neighbor == neighbors[3] and graph.nodes[neighbor]['direction'] == chars[1]) or (neighbor == neighbors[4] and graph.nodes[neighbor]['direction'] == chars[0]):
+                # If the neighbor is a cross and is one of the special characters add an edge
+                graph.add_edge(node, neighbor, weight=1)
+            elif neighbor == neighbors[2]:
+                # If the neighbor is not a diagonal add an edge
+                graph.add_edge(node, neighbor, weight=1)
+            elif neighbor != neighbors[3] and neighbor != neighbors[4]:
+                # If the neighbor is a diagonal and is not one of the special characters add an edge
+                graph.add_edge(node, neighbor, weight=diagonales)
+
+    # Add edges to the traffic lights depending in which direction they are facing
+    if (x + xVal, y + yVal) in graph.nodes and 'signal_type' in graph.nodes[(x + xVal, y + yVal)] and graph.nodes[(x + xVal, y + yVal)]['signal_type'] in ["long", "short"]:
+        graph.add_edge((x + xVal, y + yVal), (x + (xVal * 2), y + (yVal * 2)), weight=semaforos * 5)
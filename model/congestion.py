@@ -0,0 +1,113 @@
+import numpy as np
+
+# Levels are integers so both engines add them up exactly the same way
+BLOCKED = 16 # Level added to a node each time a car could not move into it
+OCCUPIED = 4 # Level added to a node for each step it has a car
+DECAY_SHIFT = 2 # Every step each level loses 1 / 2 ** DECAY_SHIFT of its value, rounded up so it gets back to 0
+
+
+class CongestionField:
+    """
+    Congestion of every node of the map, shared by all the cars of a model.
+    It is updated once per step from the moves that were blocked and the cells with cars, and fades
+    away when the traffic clears. Cars route against it and keep their path until the congestion on
+    the next nodes of it grows by more than the threshold since they calculated it. A new path only goes
+    around the congestion (with A*) when the free-flow one has more than the threshold on it, so light
+    traffic does not cost any extra search.
+    Attributes:
+        level: Congestion of each node (int64), BLOCKED for a car that just could not get in
+        weight: Extra weight of a node with a level of BLOCKED when finding a path
+        threshold: Growth of the level ahead of a car, summed over horizon nodes, that makes it look for another path.
+            Also the level summed over a whole free-flow path above which a new path goes around the congestion.
+        horizon: Nodes of the path ahead of a car that are looked at
+        check_every: Steps between two checks of each car
+        blocked: Nodes cars could not move into during the current step, added up by update
+    """
+    def __init__(self, router, weight = 0.5, threshold = 16 * BLOCKED, horizon = 8, check_every = 4):
+        """
+        Args:
+            router: The Router of the model, the field has one level per node
+            check_every: Steps between two checks of the congestion ahead of a car
+        """
+        self.level = np.zeros(len(router.nodes), dtype=np.int64)
+        self.weight = weight
+        self.threshold = threshold
+        self.horizon = horizon
+        self.check_every = check_every
+        self.blocked = []
+        self._costs = None
+        self._levels = None
+
+    def update(self, occupied):
+        """
+        Ends a step: fades the levels and adds the blocked moves and cars of the step
+        Args:
+            occupied: Boolean array with the nodes that have a car
+        """
+        self.level -= (self.level + (1 << DECAY_SHIFT) - 1) >> DECAY_SHIFT
+        self.level[occupied] += OCCUPIED
+        if self.blocked:
+            np.add.at(self.level, self.blocked, BLOCKED)
+            self.blocked = []
+        self.refresh()
+
+    def set_level(self, level):
+        """
+        Replaces the levels, like when a checkpoint is restored
+        """
+        self.level[:] = level
+        self.refresh()
+
+    def refresh(self):
+        """
+        Forgets the costs and levels read from level, after it changed
+        """
+        self._costs = None
+        self._levels = None
+
+    @property
+    def tolerance(self):
+        """
+        The threshold in the units of costs, for Router.path_indices
+        """
+        return self.threshold * (self.weight / BLOCKED)
+
+    def crowded(self, path):
+        """
+        Whether a free-flow path (an array of node indices) has enough congestion on it to look for another one
+        """
+        return int(self.level[path].sum()) > self.threshold
+
+    @property
+    def costs(self):
+        """
+        Extra weight of getting into each node for Router.a_star, as a list
+        """
+        if self._costs is None: # Only built in the steps where some car looks for a path
+            self._costs = (self.level * (self.weight / BLOCKED)).tolist()
+        return self._costs
+
+    def ahead(self, nodes):
+        """
+        Congestion of a part of a path, the sum of the levels of its nodes
+        """
+        if self._levels is None: # Plain ints, indexing the numpy array one node at a time is slow
+            self._levels = self.level.tolist()
+        levels = self._levels
+        return sum([levels[node] for node in nodes])
+
+    def due(self, age):
+        """
+        Whether a car checks the congestion ahead this step, given the steps since it was created
+        (an int or an array). Cars take turns so only some of them check each step.
+        """
+        return age % self.check_every == 0
+
+    def congested(self, ahead, baseline):
+        """
+        Whether the congestion ahead of a car grew enough since it calculated its path to look for another one
+        Args:
+            ahead: Congestion of the next nodes of the path now
+            baseline: The lowest congestion of the next nodes seen since the path was calculated
+        """
+        return ahead > baseline + self.threshold
@@ -0,0 +1,173 @@
+"""
+Demand driven spawning for CityModel: trips between sources (road cells where cars appear) and sinks
+(destinations) drawn every step from an origin-destination matrix, scaled by a time of day profile.
+
+Trips whose source cell has a car wait in a queue of that source instead of stopping the simulation.
+Every step each source with trips waiting and a free cell spawns the first one, all of them at once
+and with the route of each source and sink read from a cache, so large demands stay cheap.
+"""
+import json
+from collections import deque
+import numpy as np
+from lattice import ROAD
+
+
+class Demand:
+    """
+    Origin-destination demand of a model.
+    Attributes:
+        sources: Positions where the cars appear, road cells
+        sinks: Positions of the destinations the cars go to
+        matrix: Mean number of trips per step from each source (rows) to each sink (columns)
+        profile: Factor of the matrix for each period of steps, repeated, like 24 values for the hours of a day
+        period: Steps of each value of the profile
+        max_queue: Most trips waiting at each source, the trips that do not fit are dropped
+        queues: Sink index of each trip waiting at each source, the first one goes next
+        dropped: Trips dropped because their queue was full
+    """
+    def __init__(self, sources, sinks, matrix, profile = None, period = 1, max_queue = 100):
+        """
+        Args:
+            sources, sinks: Lists of positions
+            matrix: Trips per step, len(sources) x len(sinks)
+            profile, period, max_queue: See the attributes, no profile is a factor of 1
+        Raises ValueError if a value can not be drawn from, the sources and sinks are checked against the map by check_map
+        """
+        self.sources = [tuple(pos) for pos in sources]
+        self.sinks = [tuple(pos) for pos in sinks]
+        self.matrix = np.asarray(matrix, dtype=np.float64).reshape(len(self.sources), len(self.sinks))
+        if not (self.matrix >= 0).all() or not np.isfinite(self.matrix).all():
+            raise ValueError("The demand matrix must have finite numbers of at least 0")
+        self.profile = np.asarray(profile if profile is not None else [1.0], dtype=np.float64).ravel()
+        if not len(self.profile) or not (self.profile >= 0).all() or not np.isfinite(self.profile).all():
+            raise ValueError("The demand profile must have at least one value, all finite numbers of at least 0")
+        if int(period) != period or period < 1:
+            raise ValueError("The period of the demand profile must be a whole number of steps, at least 1")
+        if int(max_queue) != max_queue or max_queue < 0:
+            raise ValueError("max_queue must be a whole number of at least 0")
+        self.period = int(period)
+        self.max_queue = int(max_queue)
+        self.queues = [deque() for _ in self.sources]
+        self.dropped = 0
+
+        rates = self.matrix.sum(axis=1)
+        # Cumulative chance of each sink per source, each row shifted by its index so all of them can be searched at once
+        share = np.divide(self.matrix, rates[:, None], out=np.zeros_like(self.matrix), where=rates[:, None] > 0)
+        self._rates = rates
+        self._cumulative = (np.cumsum(share, axis=1) + np.arange(len(self.sources))[:, None]).ravel()
+        self._routes = {} # (source, sink) -> free-flow path as an int32 array of node indices
+        self.rng = None
+
+    @classmethod
+    def from_spec(cls, city, sources = "spawn_points", sinks = "destinations", rate = 1.0, matrix = None, profile = None, period = 1, max_queue = 100):
+        """
+        Demand for a compiled map, as given by a JSON file or the demand parameter of CityModel.
+        Args:
+            city: The CompiledMap
+            sources: "spawn_points" (the corners), "border" (every road cell on the edge of the map) or a list of positions
+            sinks: "destinations" (all of them) or a list of positions
+            rate: Trips per step spread evenly over every source and sink, when there is no matrix
+            matrix: Trips per step from each source to each sink
+        """
+        lattice = city.lattice
+        if sources == "spawn_points":
+            sources = city.spawn_points
+        elif sources == "border":
+            sources = [(x, y) for x in range(city.width) for y in range(city.height)
+                       if (x in (0, city.width - 1) or y in (0, city.height - 1)) and lattice.cell_type[x, y] == ROAD]
+        if sinks == "destinations":
+            sinks = city.destinations
+        sources, sinks = [tuple(pos) for pos in sources], [tuple(pos) for pos in sinks]
+        if matrix is None:
+            matrix = np.full((len(sources), len(sinks)), rate / max(len(sources) * len(sinks), 1))
+        demand = cls(sources, sinks, matrix, profile, period, max_queue)
+        demand.check_map(city)
+        return demand
+
+    @classmethod
+    def load(cls, city, path):
+        """
+        Demand from a JSON file with the arguments of from_spec
+        """
+        with open(path) as file:
+            return cls.from_spec(city, **json.load(file))
+
+    def check_map(self, city):
+        """
+        Raises ValueError unless the sources are road cells and the sinks destinations of a compiled map
+        """
+        lattice = city.lattice
+        if any(pos not in city.router.index or lattice.cell_type[pos] != ROAD for pos in self.sources):
+            raise ValueError("Sources must be road cells of the map")
+        if any(pos not in city.destinations for pos in self.sinks):
+            raise ValueError("Sinks must be destinations of the map")
+
+    def bind(self, model):
+        """
+        Prepares the demand for a model, its trips are drawn from a generator seeded by the model's one.
+        Raises ValueError if it is not a demand of the map of the model, see check_map.
+        """
+        self.check_map(model.city)
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+        self._source_nodes = np.array([model.router.index[pos] for pos in self.sources], dtype=np.int64)
+        self._sink_nodes = np.array([model.router.index[pos] for pos in self.sinks], dtype=np.int64)
+
+    def waiting(self):
+        """
+        Number of trips waiting in the queues
+        """
+        return sum(len(queue) for queue in self.queues)
+
+    def draw(self, step):
+        """
+        Adds the trips of a step to the queues of their sources
+        """
+        factor = self.profile[(step // self.period) % len(self.profile)]
+        counts = self.rng.poisson(self._rates * factor)
+        total = int(counts.sum())
+        if not total:
+            return
+        source = np.repeat(np.arange(len(self.sources)), counts)
+        sink = np.searchsorted(self._cumulative, self.rng.random(total) + source, side="right") - source * len(self.sinks)
+        sink = np.minimum(sink, len(self.sinks) - 1) # A draw right at the end of a row
+        for s, d in zip(source.tolist(), sink.tolist()):
+            queue = self.queues[s]
+            if len(queue) < self.max_queue:
+                queue.append(d)
+            else:
+                self.dropped += 1
+
+    def route(self, model, source, sink):
+        """
+        Cached free-flow path (node indices) of a new car, and whether it is crowded (CongestionField.crowded)
+        so CityModel.find_paths has to look for another one
+        """
+        key = (source, sink)
+        path = self._routes.get(key)
+        if path is None and key not in self._routes:
+            path = model.router.path_indices(source, sink)
+            self._routes[key] = np.array(path, dtype=np.int32) if path is not None else None
+            path = self._routes[key]
+        field = model.congestion
+        return path, path is not None and field is not None and field.crowded(path)
+
+    def inject(self, model):
+        """
+        Draws the trips of the step and spawns the first trip of every source whose cell is free
+        """
+        self.draw(model.step_count)
+        waiting = np.array([len(queue) > 0 for queue in self.queues])
+        free = ~model.occupied_nodes()[self._source_nodes]
+        ready = np.flatnonzero(waiting & free).tolist()
+        if not ready:
+            return
+        sinks = [self.queues[s].popleft() for s in ready]
+        sources, goals = self._source_nodes[ready].tolist(), self._sink_nodes[sinks].tolist()
+        paths, congested = zip(*[self.route(model, source, goal) for source, goal in zip(sources, goals)])
+        paths = list(paths)
+        around = [i for i, c in enumerate(congested) if c] # Paths found again with the congestion, all at once
+        for i, (path, _) in zip(around, model.find_paths([(sources[i], goals[i], None, None) for i in around])):
+            paths[i] = path
+        keep = [i for i, path in enumerate(paths) if path is not None] # Sinks that can not be reached from the source
+        self.dropped += len(paths) - len(keep)
+        model.spawn([sources[i] for i in keep], [goals[i] for i in keep], [paths[i] for i in keep])
@@ -0,0 +1,321 @@
+import time
+import numpy as np
+from lattice import DESTINATION
+from router import REPAIR_WINDOW
+
+
+class ArrayEngine:
+    """
+    Array engine of a CityModel. Cars and traffic lights live in numpy arrays instead of agents
+    and every step is resolved for all the cars at once.
+    The result is the same as stepping the agents with RandomActivation: the same shuffle of the
+    model's random generator decides who goes first when two cars want the same cell, and when
+    a traffic light flips before or after a car looks at it.
+    """
+    def __init__(self, model, capacity = 64):
+        """
+        Args:
+            model: The CityModel, its lattice and router must already be built
+            capacity: Number of cars the arrays start with, they grow as needed
+        """
+        self.model = model
+        self.router = model.router
+        lattice = model.lattice
+        self.height = lattice.height
+
+        self.node_cell = self.router.nodes[:, 0] * lattice.height + self.router.nodes[:, 1] # Node index -> flat cell index
+        self.cell_type = lattice.cell_type.ravel()
+        self.light_id = lattice.light_id.ravel()
+        self.light_time = lattice.light_time
+        self.light_state = lattice.light_state.copy() # False = Red, True = Green
+        self.occupancy = np.full(lattice.width * lattice.height, -1, dtype=np.int32) # Slot of the car in each cell, -1 if free
+
+        self.arena = model.arena # Shared with the model, the Car agents are not used
+        self.number = np.zeros(capacity, dtype=np.int64) # The car is "c_{number}"
+        self.ids = [None] * capacity # "c_{number}" of each slot, made once
+        self.node = np.zeros(capacity, dtype=np.int32) # Current node
+        self.goal = np.zeros(capacity, dtype=np.int32) # Destination node
+        self.cursor = np.zeros(capacity, dtype=np.int32) # Next node of the path in the arena
+        self.end = np.zeros(capacity, dtype=np.int32) # End of the path in the arena
+        self.patience = np.zeros(capacity, dtype=np.int32)
+        self.spawn_step = np.zeros(capacity, dtype=np.int64) # Step when the car was created
+        self.baseline = np.zeros(capacity, dtype=np.int64) # Lowest congestion seen ahead since the path was calculated
+        self.penalties = [None] * capacity # Dictionary edge id -> extra weight of each car, None until it gets stuck
+        self.free = list(range(capacity - 1, -1, -1)) # Unused slots
+        self.live = np.zeros(0, dtype=np.int32) # Slots of the cars in the order they were spawned
+
+    def _grow(self):
+        """
+        Doubles the capacity of the car arrays
+        """
+        capacity = len(self.number)
+        for name in ["number", "node", "goal", "cursor", "end", "patience", "spawn_step", "baseline"]:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.penalties += [None] * capacity
+        self.ids += [None] * capacity
+        self.free[:0] = range(2 * capacity - 1, capacity - 1, -1) # The slots already free are still taken first
+
+    def is_occupied(self, pos):
+        """
+        Whether there is a car in a position
+        """
+        return self.occupancy[pos[0] * self.height + pos[1]] != -1
+
+    def add_car(self, number, pos, goal, patience):
+        """
+        Spawns a car in a free position with its path already calculated
+        """
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        field = self.model.congestion
+        path = self._find_path(self.router.index[pos], self.router.index[goal], congestion=field.costs if field is not None else None)
+        if path is None:
+            print("Either the source or the destination node does not exist in the graph.")
+            path = []
+
+        self.number[slot] = number
+        self.ids[slot] = f"c_{number}"
+        self.node[slot] = self.router.index[pos]
+        self.goal[slot] = self.router.index[goal]
+        self.cursor[slot], self.end[slot] = self.arena.append(path)
+        self._reset_baseline(slot)
+        self.patience[slot] = patience
+        self.spawn_step[slot] = self.model.step_count
+        self.penalties[slot] = None
+        self.occupancy[pos[0] * self.height + pos[1]] = slot
+        self.live = np.append(self.live, np.int32(slot))
+
+    def add_cars(self, numbers, nodes, goals, patience, paths):
+        """
+        Spawns a batch of cars at free nodes with their paths already calculated (see CityModel.spawn)
+        """
+        count = len(nodes)
+        if not count:
+            return
+        while len(self.free) < count:
+            self._grow()
+        slots = np.array([self.free.pop() for _ in range(count)], dtype=np.int32)
+        nodes = np.asarray(nodes, dtype=np.int32)
+        self.number[slots] = list(numbers)
+        for slot, number in zip(slots.tolist(), numbers):
+            self.ids[slot] = f"c_{number}"
+        self.node[slots] = nodes
+        self.goal[slots] = goals
+        self.cursor[slots], self.end[slots] = self.arena.extend(paths)
+        self.patience[slots] = patience
+        self.spawn_step[slots] = self.model.step_count
+        for slot in slots.tolist():
+            self.penalties[slot] = None
+        field = self.model.congestion
+        if field is not None: # Same as _reset_baseline for all of them
+            offsets = self.cursor[slots][:, None] + np.arange(field.horizon)
+            inside = offsets < self.end[slots][:, None]
+            self.baseline[slots] = np.where(inside, field.level[self.arena.data[np.where(inside, offsets, 0)]], 0).sum(axis=1)
+        self.occupancy[self.node_cell[nodes]] = slots
+        self.live = np.concatenate([self.live, slots])
+
+    def car_positions(self):
+        """
+        List of (id, (x, y)) of the cars in the simulation
+        """
+        ids, position = self.ids, self.router.position
+        return [(ids[slot], position(node)) for slot, node in zip(self.live.tolist(), self.node[self.live].tolist())]
+
+    def occupied_nodes(self):
+        """
+        Boolean array with the nodes of the router that have a car
+        """
+        return self.occupancy[self.node_cell] >= 0
+
+    def _reset_baseline(self, slot):
+        """
+        Same as Car.reset_baseline
+        """
+        field = self.model.congestion
+        if field is not None:
+            cursor = int(self.cursor[slot])
+            self.baseline[slot] = field.ahead(self.arena.data[cursor:min(cursor + field.horizon, int(self.end[slot]))].tolist())
+
+    def _find_path(self, source, target, penalties = None, congestion = None):
+        """
+        router.path_indices, recorded in the metrics of the model if it has them
+        """
+        metrics = self.model.metrics
+        tolerance = self.model.congestion.tolerance if congestion is not None else 0.0
+        if metrics is None:
+            return self.router.path_indices(source, target, penalties, congestion, tolerance)
+        start = time.perf_counter()
+        path = self.router.path_indices(source, target, penalties, congestion, tolerance)
+        metrics.add("route", start)
+        metrics.count("routes")
+        if path is not None:
+            metrics.path_length.observe(len(path))
+        return path
+
+    def _reroute_job(self, slot):
+        """
+        Same as Car.out_of_patience up to finding the path: penalizes the edge the car is stuck on.
+        Returns the job of CityModel.find_paths of its new path, with its next nodes to try a detour first.
+        """
+        node, cursor, end = int(self.node[slot]), int(self.cursor[slot]), int(self.end[slot])
+        edge = self.router.edge_between(node, int(self.arena.data[cursor]))
+        penalties = self.penalties[slot]
+        if edge == -1:
+            return (node, int(self.goal[slot]), penalties, None)
+        if penalties is None:
+            penalties = self.penalties[slot] = {}
+        penalties[edge] = penalties.get(edge, 0) + 5 # Increase the weight of the edge only for this car
+        self.patience[slot] = self.model.random.randint(5, 10) # Reset the patience
+        return (node, int(self.goal[slot]), penalties, [node] + self.arena.data[cursor:min(cursor + REPAIR_WINDOW, end)].tolist())
+
+    def _give_path(self, slot, path, i):
+        """
+        Gives a car the result of its job in CityModel.find_paths, like Car.repair_path for a detour
+        and Car.calculate_A_star for a new path, the car keeps its path if there is no other one
+        """
+        if path is None:
+            print("Either the source or the destination node does not exist in the graph.")
+            return
+        if i is not None: # A detour to ahead[i], that is data[cursor + i - 1], keep what comes after it
+            path = path + self.arena.data[self.cursor[slot] + i:self.end[slot]].tolist()
+        self.cursor[slot], self.end[slot] = self.arena.append(path)
+        self._reset_baseline(slot)
+
+    def step(self):
+        """
+        Advances every traffic light and car one step
+        """
+        model = self.model
+        live = self.live
+        n_lights, n = len(self.light_state), len(live)
+
+        # Same activation order RandomActivation would draw: traffic lights first, then cars by age
+        order = list(range(n_lights + n))
+        model.random.shuffle(order)
+        rank = np.empty(n_lights + n, dtype=np.int64)
+        rank[order] = np.arange(n_lights + n)
+        light_rank, car_rank = rank[:n_lights], rank[n_lights:]
+        flip = model.schedule.steps % self.light_time == 0 # Lights that change this step
+        if not model.signals.self_timed: # The signal controller already set them for the step
+            flip[:] = False
+        # One more green light that never flips at the end, so cells without a light (-1) can be looked up too
+        state = np.append(self.light_state, True)
+        flips = np.append(flip, False)
+        light_rank = np.append(light_rank, 0)
+
+        # Rerouting only depends on the car itself, so the paths of every car that needs one are found at
+        # once (see CityModel.find_paths) and given in activation order
+        has_path = self.cursor[live] < self.end[live]
+        tired = np.flatnonzero(has_path & (self.patience[live] <= 0))
+        start = time.perf_counter()
+        rerouted = live[tired[np.argsort(car_rank[tired])]].tolist()
+        jobs = [self._reroute_job(slot) for slot in rerouted]
+        congested_slots = []
+        field = model.congestion
+        if field is not None: # Same as Car.check_congestion for the cars that were not rerouted
+            rested = has_path & field.due(model.step_count - self.spawn_step[live])
+            rested[tired] = False
+            calm = live[rested]
+            offsets = self.cursor[calm][:, None] + np.arange(field.horizon)
+            inside = offsets < self.end[calm][:, None]
+            ahead = np.where(inside, field.level[self.arena.data[np.where(inside, offsets, 0)]], 0).sum(axis=1)
+            congested = ahead > self.baseline[calm] + field.threshold
+            self.baseline[calm[~congested]] = np.minimum(self.baseline[calm[~congested]], ahead[~congested])
+            congested_slots = calm[congested].tolist()
+            jobs += [(int(self.node[slot]), int(self.goal[slot]), self.penalties[slot], None) for slot in congested_slots]
+        found = model.find_paths(jobs)
+        for slot, (path, i) in zip(rerouted, found):
+            self._give_path(slot, path, i)
+        for slot, (path, i) in zip(congested_slots, found[len(rerouted):]):
+            self._give_path(slot, path, i)
+            if self.cursor[slot] < self.end[slot] and self.arena.data[self.cursor[slot]] == self.node[slot]:
+                self.cursor[slot] += 1 # Same as Car.check_congestion, do not lose a step on the current position
+        metrics = model.metrics
+        if metrics is not None:
+            metrics.add("reroute", start)
+            metrics.count("reroutes", len(tired))
+            if field is not None:
+                metrics.count("congestion_reroutes", len(congested_slots))
+        start = time.perf_counter()
+
+        # Where each car wants to go
+        target = np.full(n, -1, dtype=np.int64)
+        target[has_path] = self.arena.data[self.cursor[live[has_path]]]
+        cell = np.where(has_path, self.node_cell[target], -1)
+        own = self.node_cell[self.node[live]]
+        light = np.where(has_path, self.light_id[cell], -1)
+        # A light that flips this step is seen with its new state only by the cars that go after it
+        red = ~(state[light] ^ (flips[light] & (car_rank > light_rank[light])))
+        arrive = has_path & ~red & (self.cell_type[cell] == DESTINATION)
+
+        # Car in the target cell, as a position in live (-1 if none or if it is the car itself)
+        position = np.full(len(self.number), -1, dtype=np.int64)
+        position[live] = np.arange(n)
+        occupant = np.where(has_path, self.occupancy[cell], -1)
+        occupant = np.where(occupant >= 0, position[occupant], -1)
+        occupant[occupant == np.arange(n)] = -1
+
+        # 0 = undecided, 1 = moves, 2 = blocked by a car, 3 = waits (red light or no path)
+        status = np.zeros(n, dtype=np.int8)
+        status[~has_path | red] = 3
+        status[arrive] = 1
+        vacates = arrive.copy()
+        never = n_lights + n # Rank after everybody
+
+        # A cell is free for the cars going after its occupant if the occupant leaves it, the first of
+        # those cars takes it. Each round decides the cars whose occupant is already decided.
+        pending = np.flatnonzero(status == 0)
+        while len(pending):
+            o = occupant[pending]
+            ready = (o < 0) | (status[np.maximum(o, 0)] != 0)
+            if not ready.any(): # Cars waiting on each other in a loop, nobody moves
+                status[pending] = 2
+                break
+            i, o = pending[ready], o[ready]
+            free_after = np.where(o < 0, -1, np.where(vacates[np.maximum(o, 0)], car_rank[np.maximum(o, 0)], never))
+            contender = i[car_rank[i] > free_after]
+            contender = contender[np.lexsort((car_rank[contender], cell[contender]))]
+            first = np.ones(len(contender), dtype=bool)
+            first[1:] = cell[contender][1:] != cell[contender][:-1]
+            status[i] = 2
+            winner = contender[first]
+            status[winner] = 1
+            vacates[winner] = cell[winner] != own[winner]
+            pending = pending[~ready]
+
+        # Apply the moves
+        moves = (status == 1) & ~arrive
+        self.patience[live[status == 2]] -= 1
+        self.occupancy[own[vacates]] = -1
+        self.occupancy[cell[moves]] = live[moves]
+        self.node[live[moves]] = target[moves]
+        self.cursor[live[moves]] += 1
+
+        arrived = live[arrive]
+        if len(arrived):
+            for slot in arrived.tolist():
+                self.penalties[slot] = None
+                self.ids[slot] = None
+                self.free.append(slot)
+            self.live = live[~arrive]
+            model.car_count -= len(arrived)
+            model.arrived_cars += len(arrived)
+            model.total_travel_time += int((model.step_count - self.spawn_step[arrived]).sum())
+        if field is not None:
+            field.blocked += target[status == 2].tolist()
+        if metrics is not None:
+            metrics.add("move", start)
+            metrics.count("blocked_moves", int((status == 2).sum()))
+
+        self.light_state ^= flip
+        for i in np.flatnonzero(flip).tolist(): # Keep the agents up to date for the visualization and the server
+            model.traffic_lights[i].state = bool(self.light_state[i])
+        model.schedule.steps += 1
+        model.schedule.time += 1
+
+        # Drop the paths left behind by rerouting once they are most of the arena
+        used = int((self.end[self.live] - self.cursor[self.live]).sum())
+        if self.arena.size > 4 * used + 4096:
+            self.cursor[self.live], self.end[self.live] = self.arena.compact(self.cursor[self.live], self.end[self.live])
@@ -1,53 +1,215 @@
 # Python flask server to interact with Unity. Based on the code provided by Octavio Navarro.
 # Rodrigo Nunez. November 2023
 
-from flask import Flask, request, jsonify
-from model import CityModel
-from agent import Car, Traffic_Light
+from flask import Flask, Response, request, jsonify, g
+from streaming import DeltaEncoder
+from sessions import SessionPool, SessionNotFound, SessionPoolFull
+from metrics import Histogram, histogram_families, render
+from signals import POLICIES
+from checkpoint import restore, OVERRIDES
 import requests
 import json
+import math
+import time
 
 app = Flask("Traffic simulation")
 
 send_arrived_cars_endpoint = "http://52.1.3.19:8585/api/attempts"
 
-model = None
-current_step = 0
+# Every client gets its own model. Requests choose it with the "session" query parameter returned by /init,
+# requests without it (like the Unity client) use the last session created.
+# Each session computes up to run_ahead steps before its client asks for them.
+pool = SessionPool(max_sessions=16, idle_timeout=600, workers=4, run_ahead=8)
+
+# Query parameters of /init passed to CityModel and their types
+model_params = {"diagonales": float, "paciencia": int, "semaforos": float, "seed": int, "engine": str, "signals": str}
+ENGINES = ["objects", "array"]
+# Values of the numeric ones CityModel can run with, the weights of the map must be positive numbers
+valid_values = {"diagonales": lambda value: math.isfinite(value) and value > 0,
+                "semaforos": lambda value: math.isfinite(value) and value > 0,
+                "paciencia": lambda value: value >= 0}
+
+def read_params(names):
+    """
+    Values of the query parameters of model_params in names that the request has.
+    Returns (params, None), or (None, message) when one of them is not valid.
+    """
+    params = {}
+    for name in names:
+        if name not in request.args:
+            continue
+        params[name] = request.args.get(name, type=model_params[name]) # None if it does not convert
+        if params[name] is None or not valid_values.get(name, lambda value: True)(params[name]):
+            return None, f"Invalid value for {name}: {request.args[name]}."
+    if 'engine' in params and params['engine'] not in ENGINES:
+        return None, f"Unknown engine, use one of {ENGINES}."
+    if 'signals' in params and params['signals'] not in POLICIES:
+        return None, f"Unknown signals policy, use one of {list(POLICIES)}."
+    return params, None
+
+# Record the step timings and counters of every session for /metrics, False to skip the instrumentation
+record_metrics = True
+request_seconds = {} # Endpoint -> Histogram of the duration of its requests
+
+@app.before_request
+def startTimer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def stopTimer(response):
+    if record_metrics and request.endpoint is not None and request.endpoint != 'streamModel': # A stream lasts as long as the client wants
+        if request.endpoint not in request_seconds:
+            request_seconds[request.endpoint] = Histogram()
+        request_seconds[request.endpoint].observe(time.perf_counter() - g.start)
+    return response
+
+@app.errorhandler(SessionNotFound)
+def sessionNotFound(error):
+    return jsonify({"message": "Unknown session, call /init first."}), 404
+
+@app.errorhandler(SessionPoolFull)
+def sessionPoolFull(error):
+    return jsonify({"message": "Too many simulations running, try again later."}), 503
 
 @app.route('/init', methods=['GET'])
 def initModel():
-    global model, current_step
     if request.method == 'GET':
-        current_step = 0
-        model = CityModel()
-        return jsonify({"message":"Model initiated."})
+        params, error = read_params(model_params)
+        if error is not None:
+            return jsonify({"message": error}), 400
+        if 'session' in request.args: # Start an existing session over, like when its parameters change
+            session = pool.reset(request.args['session'], metrics=record_metrics, **params)
+        else:
+            session = pool.create(metrics=record_metrics, **params)
+        return jsonify({"message":"Model initiated.", "session": session.id})
 
     
 @app.route('/getAgents', methods=['GET'])
 def getAgents():
-    global model
     if request.method == 'GET':
-        agent_positions = [{"id": a.unique_id, "x": a.pos[0], "y":0, "z":a.pos[1]}
-                          for a in model.schedule.agents
-                          if isinstance(a, Car)]
-        traffic_lights = [{"id": a.unique_id, "x": a.pos[0], "y":0, "z":a.pos[1], "isGreen":a.state}
-                          for a in model.schedule.agents
-                          if isinstance(a, Traffic_Light)]
-        return jsonify({'positions':agent_positions,
-                       'traffic_lights':traffic_lights})
+        session = pool.get(request.args.get('session'))
+        # Cars and traffic lights at the client's step, already serialized when the session runs ahead
+        return Response(session.snapshot().agents_json, mimetype='application/json')
 
 @app.route("/update", methods=['GET'])
 def updateModel():
-    global current_step, model
     if request.method == 'GET':
-        model.step()
-        current_step += 1
+        session = pool.get(request.args.get('session'))
+        current_step = pool.step(session)
         # if current_step % 100 == 0:
-        #     send_arrived_cars()
+        #     send_arrived_cars(session.model)
         return jsonify({'message':f'Model updated to step {current_step}.', 'current_step':current_step})
+
+@app.route("/close", methods=['GET'])
+def closeModel():
+    if request.method == 'GET':
+        pool.close(request.args.get('session'))
+        return jsonify({"message":"Model closed."})
     
-def send_arrived_cars():
-    global model
+@app.route("/stream", methods=['GET'])
+def streamModel():
+    """
+    Advances the model and streams the changes of every step as binary frames (see streaming.py),
+    instead of calling /update and /getAgents each step.
+    Query parameters:
+        steps: Number of steps to advance, 0 (the default) streams until the client disconnects
+        keyframe: Send the whole state every this many steps (default 50), at least 1
+        interval: Seconds to wait between steps (default 0)
+    """
+    if request.method == 'GET':
+        session = pool.get(request.args.get('session'))
+        steps = request.args.get('steps', default=0, type=int)
+        keyframe = request.args.get('keyframe', default=50, type=int)
+        interval = request.args.get('interval', default=0.0, type=float)
+        if steps < 0 or keyframe < 1 or interval < 0:
+            return jsonify({"message": "steps and interval must be numbers of at least 0, keyframe at least 1."}), 400
+        
+        def generate():
+            encoder = DeltaEncoder(session.model, keyframe)
+            snapshot = session.snapshot()
+            yield encoder.encode(snapshot.step, snapshot.cars, snapshot.lights) # The state before the first step, always a keyframe
+            count = 0
+            while steps == 0 or count < steps:
+                pool.step(session)
+                count += 1
+                snapshot = session.snapshot()
+                yield encoder.encode(snapshot.step, snapshot.cars, snapshot.lights)
+                if interval:
+                    time.sleep(interval)
+        
+        return Response(generate(), mimetype='application/octet-stream')
+    
+@app.route("/metrics", methods=['GET'])
+def getMetrics():
+    """
+    Timings and counters of the server and of every session, in the Prometheus text format
+    """
+    if request.method == 'GET':
+        families = histogram_families([("traffic_request_seconds", "Duration of the requests", histogram, {"endpoint": endpoint})
+                                       for endpoint, histogram in list(request_seconds.items())])
+        for session in pool.all():
+            if session.model.metrics is not None:
+                families += session.model.metrics.families(session.model, {"session": session.id})
+        return Response(render(families), mimetype='text/plain; version=0.0.4')
+
+@app.route("/profile", methods=['GET'])
+def profileModel():
+    """
+    Profiles the next steps of a session with cProfile.
+    Query parameters:
+        steps: Number of steps to profile, at least 1. Without it, returns the report of the last profile.
+    """
+    if request.method == 'GET':
+        session = pool.get(request.args.get('session'))
+        metrics = session.model.metrics
+        if metrics is None:
+            return jsonify({"message": "The session does not record metrics."}), 409
+        if 'steps' in request.args:
+            steps = request.args.get('steps', type=int)
+            if steps is None or steps < 1:
+                return jsonify({"message": "steps must be a whole number of at least 1."}), 400
+            metrics.start_profile(steps)
+            return jsonify({"message": f"Profiling the next {metrics.profile_steps} steps."})
+        if metrics.report is None:
+            return jsonify({"message": f"No profile yet, {metrics.profile_steps} steps left."}), 404
+        return Response(metrics.report, mimetype='text/plain')
+
+@app.route("/checkpoint", methods=['GET'])
+def checkpointModel():
+    """
+    Checkpoint of a session (see checkpoint.py) as a binary body, to fork it later with /restore.
+    It is of the last step the session computed, given in the X-Step header: when the session runs
+    ahead that step can be ahead of the client.
+    """
+    if request.method == 'GET':
+        session = pool.get(request.args.get('session'))
+        step, data = session.checkpoint()
+        return Response(data, mimetype='application/octet-stream', headers={"X-Step": str(step)})
+
+@app.route("/restore", methods=['POST'])
+def restoreModel():
+    """
+    Creates a session from a checkpoint sent as the body of the request. The same checkpoint can be
+    restored many times, every session goes on from it on its own.
+    Query parameters:
+        session: Session to start over from the checkpoint instead of creating a new one
+        paciencia, engine, signals: New values for the restored model, for what-if runs
+    """
+    if request.method == 'POST':
+        overrides, error = read_params([name for name in model_params if name in OVERRIDES])
+        if error is not None:
+            return jsonify({"message": error}), 400
+        try:
+            model = restore(request.get_data(), metrics=record_metrics, **overrides)
+        except ValueError as error:
+            return jsonify({"message": str(error)}), 400
+        if 'session' in request.args:
+            session = pool.replace(request.args['session'], model)
+        else:
+            session = pool.add(model)
+        return jsonify({"message": "Model restored.", "session": session.id, "current_step": session.current_step})
+
+def send_arrived_cars(model):
     data = {
         "year" : 2023,
         "classroom" : 302,
@@ -63,4 +225,4 @@ def send_arrived_cars():
     print("Response:", response.json())
     
 if __name__ == '__main__':
-    app.run(debug=True, port = 8585, host = "localhost")
\ No newline at end of file
+    app.run(debug=True, port = 8585, host = "localhost", threaded=True)
\ No newline at end of file
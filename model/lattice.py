@@ -0,0 +1,79 @@
+import numpy as np
+
+# Cell types of the lattice
+EMPTY = 0
+ROAD = 1
+TRAFFIC_LIGHT = 2
+OBSTACLE = 3
+DESTINATION = 4
+
+# Road directions of the lattice, 0 where the cell is not a road
+DIRECTIONS = {"^": 1, "v": 2, ">": 3, "<": 4}
+
+
+class Lattice:
+    """
+    Static integer grids of the city built once from the map file.
+    Every grid is indexed as [x, y], with y = 0 at the bottom row of the file like the MultiGrid.
+    Attributes:
+        cell_type: Type of each cell (EMPTY, ROAD, TRAFFIC_LIGHT, OBSTACLE or DESTINATION)
+        direction: Direction of each road cell (see DIRECTIONS)
+        direction_names: Name of each direction code in the map dictionary ("Up", "Down"...), like Road.direction
+        light_id: Index of the traffic light in each cell, -1 where there is none
+        light_pos: Position of each traffic light, in the same order as CityModel.traffic_lights
+        light_time: timeToChange of each traffic light
+        light_state: Initial state of each traffic light (True = green)
+    """
+    def __init__(self, cell_type, direction, light_id, light_time, light_state, direction_names):
+        """
+        Builds the lattice from its grids, see parse to build it from a map file.
+        Args:
+            cell_type, direction, light_id: Grids indexed as [x, y]
+            light_time, light_state: timeToChange and initial state of each traffic light
+            direction_names: Name of each direction code
+        """
+        self.cell_type = np.asarray(cell_type, dtype=np.int8)
+        self.direction = np.asarray(direction, dtype=np.int8)
+        self.light_id = np.asarray(light_id, dtype=np.int32)
+        self.light_time = np.asarray(light_time, dtype=np.int32)
+        self.light_state = np.asarray(light_state, dtype=bool)
+        self.direction_names = list(direction_names)
+        self.width, self.height = self.cell_type.shape
+
+        cells = np.flatnonzero(self.light_id.ravel() >= 0)
+        cells = cells[np.argsort(self.light_id.ravel()[cells])] # Flat cell of each light, by light id
+        self.light_pos = list(zip((cells // self.height).tolist(), (cells % self.height).tolist()))
+
+    @classmethod
+    def parse(cls, lines, dataDictionary, width, height):
+        """
+        Builds the lattice from a map file.
+        Args:
+            lines: Lines of the map file
+            dataDictionary: The map dictionary (character -> agent data)
+            width, height: Size of the map
+        """
+        cell_type = np.zeros((width, height), dtype=np.int8)
+        direction = np.zeros((width, height), dtype=np.int8)
+        light_id = np.full((width, height), -1, dtype=np.int32)
+        light_time = []
+        light_state = []
+
+        for r, row in enumerate(lines): # Same traversal as city_map.init_Graph
+            for c, col in enumerate(row):
+                pos = (c, height - r - 1)
+                if col in DIRECTIONS:
+                    cell_type[pos] = ROAD
+                    direction[pos] = DIRECTIONS[col]
+                elif col in ["S", "s"]:
+                    cell_type[pos] = TRAFFIC_LIGHT
+                    light_id[pos] = len(light_time)
+                    light_time.append(int(dataDictionary[col]))
+                    light_state.append(col != "S") # "S" starts red and "s" starts green
+                elif col == "#":
+                    cell_type[pos] = OBSTACLE
+                elif col == "D":
+                    cell_type[pos] = DESTINATION
+
+        direction_names = [None] + [dataDictionary[char] for char in DIRECTIONS]
+        return cls(cell_type, direction, light_id, light_time, light_state, direction_names)
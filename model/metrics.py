@@ -0,0 +1,207 @@
+"""
+Timings and counters of the simulation, exposed by the /metrics endpoint in the Prometheus text format.
+
+A model only records them when it is created with metrics=True, otherwise CityModel.metrics is None and
+the instrumented code only pays for that check.
+"""
+import bisect
+import cProfile
+import io
+import pstats
+import time
+from collections import deque
+
+# Phases of a step timed by CityModel, Car and ArrayEngine. They can overlap: spawn includes finding the
+# paths of the new cars (route) and reroute includes finding the new path (route) too.
+PHASES = ["spawn", "route", "reroute", "move"]
+COUNTERS = {
+    "routes": "Paths calculated, including the ones of new cars",
+    "reroutes": "Times a car ran out of patience and looked for another path",
+    "repairs": "Reroutes solved with a short detour back onto the current path instead of a new path",
+    "congestion_reroutes": "Times a car looked for another path because the congestion ahead of it grew",
+    "blocked_moves": "Times a car could not move because the next cell had another car",
+}
+
+SECONDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LENGTHS = (4, 8, 16, 32, 64, 128, 256, 512, 1024)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """
+    Prometheus histogram (cumulative buckets, sum and count) that also keeps the last observations,
+    so the quantiles of the recent steps can be given alongside.
+    """
+    def __init__(self, buckets = SECONDS, window = 1000):
+        """
+        Args:
+            buckets: Upper bounds of the buckets, sorted
+            window: Number of recent observations kept for the quantiles
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def samples(self, name, labels):
+        """
+        Lines of the histogram, then of the summary name_recent with the quantiles of the recent observations
+        """
+        lines = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {total}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+
+        recent = sorted(self.recent)
+        quantiles = []
+        for q in QUANTILES:
+            value = recent[min(int(q * len(recent)), len(recent) - 1)] if recent else "NaN"
+            quantiles.append(f"{name}_recent{format_labels({**labels, 'quantile': q})} {value}")
+        quantiles.append(f"{name}_recent_sum{format_labels(labels)} {sum(recent)}")
+        quantiles.append(f"{name}_recent_count{format_labels(labels)} {len(recent)}")
+        return lines, quantiles
+
+
+class Metrics:
+    """
+    Timings and counters of one model.
+    Attributes:
+        step_seconds: Histogram of the duration of whole steps
+        phase_seconds: Histogram of the time each phase took in each step
+        serialize_seconds: Histogram of the time to serialize the agents for /getAgents
+        path_length: Histogram of the length of the paths calculated
+        counters: Dictionary counter name (see COUNTERS) -> total
+        report: Text of the last profile, see start_profile
+    """
+    def __init__(self, window = 1000):
+        """
+        Args:
+            window: Number of recent steps kept for the quantiles
+        """
+        self.step_seconds = Histogram(SECONDS, window)
+        self.phase_seconds = {phase: Histogram(SECONDS, window) for phase in PHASES}
+        self.serialize_seconds = Histogram(SECONDS, window)
+        self.path_length = Histogram(LENGTHS, window)
+        self.counters = {name: 0 for name in COUNTERS}
+        self.current = {phase: 0.0 for phase in PHASES} # Time of each phase in the step being run
+        self.started = None
+        self.profile_steps = 0 # Steps left to profile
+        self.profiler = None
+        self.report = None
+
+    def begin_step(self):
+        self.current = {phase: 0.0 for phase in PHASES}
+        if self.profile_steps:
+            self.profiler.enable()
+        self.started = time.perf_counter()
+
+    def end_step(self):
+        self.step_seconds.observe(time.perf_counter() - self.started)
+        for phase, seconds in self.current.items():
+            self.phase_seconds[phase].observe(seconds)
+        if self.profile_steps:
+            self.profiler.disable()
+            self.profile_steps -= 1
+            if not self.profile_steps:
+                self._finish_profile()
+
+    def add(self, phase, start):
+        """
+        Adds the time since start (a time.perf_counter()) to a phase of the current step
+        """
+        self.current[phase] += time.perf_counter() - start
+
+    def count(self, name, amount = 1):
+        self.counters[name] += amount
+
+    def start_profile(self, steps, sort = "cumulative", limit = 40):
+        """
+        Runs the next steps under cProfile. Their report is left in report once they are done.
+        Args:
+            steps: Number of steps to profile, at least 1
+            sort: pstats order of the report
+            limit: Number of functions in the report
+        """
+        if not isinstance(steps, int) or steps < 1:
+            raise ValueError("steps must be a whole number of at least 1")
+        self.profiler = cProfile.Profile()
+        self.profile_sort, self.profile_limit = sort, limit
+        self.report = None
+        self.profile_steps = steps
+
+    def _finish_profile(self):
+        text = io.StringIO()
+        pstats.Stats(self.profiler, stream=text).sort_stats(self.profile_sort).print_stats(self.profile_limit)
+        self.report = text.getvalue()
+        self.profiler = None
+
+    def families(self, model, labels):
+        """
+        Metric families of this model for render, each one is (name, type, help, lines)
+        Args:
+            model: The CityModel, for its current state
+            labels: Labels added to every sample, like the session
+        """
+        families = [
+            ("traffic_step", "gauge", "Steps the model has run", [f"traffic_step{format_labels(labels)} {model.step_count}"]),
+            ("traffic_cars_alive", "gauge", "Cars in the simulation", [f"traffic_cars_alive{format_labels(labels)} {model.car_count}"]),
+            ("traffic_cars_spawned_total", "counter", "Cars created", [f"traffic_cars_spawned_total{format_labels(labels)} {model.total_cars}"]),
+            ("traffic_cars_arrived_total", "counter", "Cars that got to their destination", [f"traffic_cars_arrived_total{format_labels(labels)} {model.arrived_cars}"]),
+        ]
+        if model.demand is not None:
+            families.append(("traffic_spawn_queue", "gauge", "Trips waiting for their source cell to be free", [f"traffic_spawn_queue{format_labels(labels)} {model.demand.waiting()}"]))
+            families.append(("traffic_trips_dropped_total", "counter", "Trips dropped because the queue of their source was full", [f"traffic_trips_dropped_total{format_labels(labels)} {model.demand.dropped}"]))
+        for name, help in COUNTERS.items():
+            families.append((f"traffic_{name}_total", "counter", help, [f"traffic_{name}_total{format_labels(labels)} {self.counters[name]}"]))
+
+        histograms = [("traffic_step_seconds", "Duration of a step", self.step_seconds, labels)]
+        histograms += [("traffic_step_phase_seconds", "Time of each phase of a step", self.phase_seconds[phase], {**labels, "phase": phase}) for phase in PHASES]
+        histograms.append(("traffic_serialize_seconds", "Time to serialize the agents for /getAgents", self.serialize_seconds, labels))
+        histograms.append(("traffic_path_length", "Cells of the paths calculated", self.path_length, labels))
+        families += histogram_families(histograms)
+        return families
+
+
+def histogram_families(histograms):
+    """
+    Families of a list of (name, help, Histogram, labels), histograms with the same name go in one family
+    """
+    families = []
+    for name, help, histogram, labels in histograms:
+        lines, quantiles = histogram.samples(name, labels)
+        families.append((name, "histogram", help, lines))
+        families.append((f"{name}_recent", "summary", f"{help}, over the last {histogram.recent.maxlen} observations", quantiles))
+    return families
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render(families):
+    """
+    Prometheus text of a list of families, the samples of families with the same name are put together
+    """
+    merged = {}
+    for name, kind, help, lines in families:
+        if name not in merged:
+            merged[name] = (kind, help, [])
+        merged[name][2].extend(lines)
+    text = []
+    for name, (kind, help, lines) in merged.items():
+        text.append(f"# HELP {name} {help}")
+        text.append(f"# TYPE {name} {kind}")
+        text.extend(lines)
+    return "\n".join(text) + "\n"
@@ -2,133 +2,138 @@ from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from agent import Car, Road, Traffic_Light, Obstacle, Destination
-import json
-import random
+from city_map import compile_map
+from lattice import ROAD, OBSTACLE, DESTINATION
+from engine import ArrayEngine
+from path_arena import PathArena
+from metrics import Metrics
+from congestion import CongestionField
+from signals import POLICIES
+from demand import Demand
+import numpy as np
+import time
 import networkx as nx
-import matplotlib.pyplot as plt
 
 class CityModel(Model):
     """ 
     Creates a model based on a city map with one-way streets.
     Args:
         N: Number of agents in the simulation (assuming 1 for a single car)
+        map_file: Text file with the map of the city
+        engine: "objects" to step Car and Traffic_Light agents, "array" to step them all at once with numpy (ArrayEngine)
+        seed: Seed of the random generator of the model, every random choice of the simulation is taken from it
+        static_agents: Whether to create the Road, Obstacle and Destination agents, only the visualization needs them
+        metrics: Whether to record the timings and counters of every step (see metrics.py)
+        congestion: Weight of the shared congestion field the cars route against (see CongestionField), 0 to turn it off
+        signals: Policy of the traffic lights, a name of signals.POLICIES ("legacy", "fixed", "actuated", "max_pressure") or a SignalController subclass.
+            "legacy" (the default) flips every light on its own timeToChange like the original model.
+        demand: Trips of the cars (see demand.Demand): a Demand, a dictionary with the arguments of Demand.from_spec or a JSON file with them.
+            None spawns a car at each corner every 3 steps and stops the simulation when a corner is blocked, like the original model.
     """
-    def __init__(self, diagonales = 1.5, paciencia = 1, semaforos = 5):
-        # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-            self.dataDictionary = json.load(open("city_files/mapDictionary.json"))
-            self.map = 0 # The map of the city
-            self.destinations = [] # The list of destinations
+    def __init__(self, diagonales = 1.5, paciencia = 1, semaforos = 5, map_file = 'city_files/2023_base.txt', engine = "objects", seed = None, static_agents = False, metrics = False, congestion = 0.5, signals = "legacy", demand = None):
+        # Load the compiled map. It is parsed from the map file and the map dictionary only the first time (see city_map).
+            if seed is not None:
+                self.reset_randomizer(seed)
             self.step_count = 0 # The number of steps that have passed
             self.car_count = 0 # The number of cars that have been created
             self.total_cars = 0 # The total number of cars that have been created
             self.arrived_cars = 0 # The number of cars that have arrived at their destination 
+            self.total_travel_time = 0 # The sum of the steps that the arrived cars took to get to their destination
             #variables for sliders
             self.diagonales = diagonales # parameter for the weight of the diagonals by slider
             self.paciencia = paciencia # parameter for the patience of the cars by slider
             self.semaforos = semaforos # parameter for the weight of the traffic lights by slider
+            self.map_file = map_file
+            self.static_agents = static_agents
+            self.metrics = Metrics() if metrics else None # None skips the instrumentation
             
             self.traffic_lights = []
-            graph = nx.DiGraph()  # Change to directed graph     
+            self.city = compile_map(map_file, diagonales, semaforos) # Shared by every model of the same map and weights
+            self.width = self.city.width # The width of the map
+            self.height = self.city.height # The height of the map
+            self.destinations = self.city.destinations # The list of destinations
+            self.spawn_points = self.city.spawn_points # The spawn points of the cars
+            
+            self.grid = MultiGrid(self.width, self.height, torus=False) # The grid where the agents are placed
+            self.schedule = RandomActivation(self) # The schedule of the agents
+            
+            self.router = self.city.router # The map compiled into arrays for the cars to find their paths, cars keep their own penalties
+            self.lattice = self.city.lattice # Static grids of the city
+            self.congestion = CongestionField(self.router, congestion) if congestion else None # Shared by the cars, unlike their penalties
+            self._init_agents()
+            self.occupancy = np.zeros((self.width, self.height), dtype=bool) # Cells with a car
+            self.arena = PathArena() # Paths of every car as node indices, back to back
+            self.cars = {} # Id -> Car of the cars in the simulation, in the order they were spawned
+            self.engine = ArrayEngine(self) if engine == "array" else None # None steps the agents
+            self.signals = (POLICIES[signals] if isinstance(signals, str) else signals)(self) # Runs the traffic lights
+            if not self.signals.self_timed:
+                self.set_lights(np.flatnonzero(self.signals.state != self.lattice.light_state))
+            
+            self.running = True
 
-            # Load the map file. The map file is a text file where each character represents an agent.
-            with open('city_files/2023_base.txt') as baseFile:
-                lines = baseFile.readlines() # Read the lines of the file
-                self.width = len(lines[0]) - 1 # The width of the map
-                self.height = len(lines) # The height of the map
-                
-                # The spawn points of the cars
-                self.spawn_points = [(0, 0), (self.width - 1, 0), (0,self.height - 1), (self.width - 1, self.height - 1)]
-                
-                self.grid = MultiGrid(self.width, self.height, torus=False) # The grid where the agents are placed
-                self.schedule = RandomActivation(self) # The schedule of the agents
-                
-                self.map = self._init_Graph(graph, lines, self.dataDictionary)
-                
-                self.running = True
-                
+            if isinstance(demand, str):
+                demand = Demand.load(self.city, demand)
+            elif isinstance(demand, dict):
+                demand = Demand.from_spec(self.city, **demand)
+            self.demand = demand
+            if demand is not None:
+                demand.bind(self) # Its cars start coming in the first step
+            else:
                 self.add_cars()
 
-                # Goes through each character in the map file and creates the corresponding agent.
-        
-    def _init_Graph(self, graph, lines, dataDictionary):
-            for r, row in enumerate(lines): # r = row, c = column
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<"]: # If the character is a road
-                        agent = Road(f"r_{r * self.width + c}", self, dataDictionary[col]) # Create a new road agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1)) # Place the agent in the grid
-                        graph.add_node((c, self.height - r - 1), direction=col)  # Add direction as an attribute
+    @property
+    def map(self):
+        """
+        The graph of the city (networkx DiGraph), only built when it is asked for
+        """
+        return self.city.graph
 
-                    elif col in ["S", "s"]: # If the character is a traffic light
-                        agent = Traffic_Light(f"tl_{r * self.width + c}", self, False if col == "S" else True, int(dataDictionary[col])) # Create a new traffic light agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1))  # Place the agent in the grid
-                        self.schedule.add(agent) # Add the agent to the schedule
-                        self.traffic_lights.append(agent)
-                        # Add an attribute to mark "S" as "long" and "s" as "short"
-                        graph.add_node((c, self.height - r - 1), direction=None, signal_type="long" if col == "S" else "short")
-                        # print("signal_type: ", graph.nodes[(c, self.height - r - 1)]['signal_type'])
+    def _init_agents(self):
+            lattice = self.lattice
+            for id, pos in enumerate(lattice.light_pos): # Same order as the map file
+                number = (self.height - pos[1] - 1) * self.width + pos[0] # r * width + c
+                agent = Traffic_Light(f"tl_{number}", self, bool(lattice.light_state[id]), int(lattice.light_time[id])) # Create a new traffic light agent
+                self.grid.place_agent(agent, pos)  # Place the agent in the grid
+                self.schedule.add(agent) # Add the agent to the schedule
+                self.traffic_lights.append(agent)
 
-                    elif col == "#": # If the character is an obstacle
+            if not self.static_agents:
+                return
+            for r in range(self.height): # r = row, c = column
+                for c in range(self.width):
+                    pos = (c, self.height - r - 1)
+                    kind = lattice.cell_type[pos]
+                    if kind == ROAD: # If the cell is a road
+                        agent = Road(f"r_{r * self.width + c}", self, lattice.direction_names[lattice.direction[pos]]) # Create a new road agent
+                    elif kind == OBSTACLE: # If the cell is an obstacle
                         agent = Obstacle(f"ob_{r * self.width + c}", self) # Create a new obstacle agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col == "D": # If the character is a destination
+                    elif kind == DESTINATION: # If the cell is a destination
                         agent = Destination(f"d_{r * self.width + c}", self) # Create a new destination agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        graph.add_node((c, self.height - r - 1), direction=None)  # No direction for destination
-                        self.destinations.append((c, self.height - r - 1)) # Add destination pos to the list
-                        
-            for node in graph.nodes:                
-                x, y = node                
-                
-                if graph.nodes[node]['direction'] == "^":
-                    self.adding_edges(graph, node, x, y, 0, 1, [(x - 1, y + 1), (x + 1, y + 1), (x, y + 1), (x - 1 , y), (x + 1, y)], [">", "<"])
-                    #adding_edges(graph, node, x, y, direccionY, direccionY, neighbors a conectar, caracteres especiales)
-                
-                if graph.nodes[node]['direction'] == "v":
-                    self.adding_edges(graph, node, x, y, 0, -1, [(x + 1, y - 1), (x - 1, y - 1),(x, y - 1), (x + 1, y), (x - 1, y)], ["<", ">"])
-                
-                if graph.nodes[node]['direction'] == "<":
-                    self.adding_edges(graph, node, x, y, -1, 0, [(x - 1, y - 1), (x - 1, y + 1), (x - 1, y), (x, y - 1), (x, y + 1)], ["^", "v"])
-                      
-                if graph.nodes[node]['direction'] == ">":
-                    self.adding_edges(graph, node, x, y, 1, 0, [(x + 1, y - 1), (x + 1, y + 1), (x + 1, y), (x, y - 1), (x, y + 1)], ["^", "v"])
-                
-            return graph     
-    
-    def adding_edges(self, graph, node, x, y, xVal, yVal, neighbors, chars):
-        for neighbor in neighbors: 
-                if neighbor in graph.nodes: # If the neighbor is in the graph
-                    if graph.nodes[neighbor]['direction'] in chars and ( neighbor == neighbors[0] or neighbor == neighbors[1]):
-                        # If the neighbor is a diagonal and is one of the special characters do not add an edge
-                        print("")                        
-                    elif (neighbor == neighbors[3] and graph.nodes[neighbor]['direction'] == chars[1]) or (neighbor == neighbors[4] and graph.nodes[neighbor]['direction'] == chars[0]):
-                        # If the neighbor is a cross and is one of the special characters add an edge
-                        graph.add_edge(node, neighbor, weight=1)
-                    elif neighbor == neighbors[2]: 
-                        # If the neighbor is not a diagonal add an edge                                
-                        graph.add_edge(node, neighbor, weight=1)
-                    elif neighbor != neighbors[3] and neighbor != neighbors[4]:
-                        # If the neighbor is a diagonal and is not one of the special characters add an edge
-                        graph.add_edge(node, neighbor, weight=self.diagonales)
-        
-        # Add edges to the traffic lights depending in which direction they are facing
-        if (x + xVal, y + yVal) in graph.nodes and 'signal_type' in graph.nodes[(x + xVal, y + yVal)] and graph.nodes[(x + xVal, y + yVal)]['signal_type'] in ["long", "short"]:
-            graph.add_edge((x + xVal, y + yVal), (x + (xVal * 2), y + (yVal * 2)), weight=self.semaforos * 5)
-        
-        
+                    else:
+                        continue
+                    self.grid.place_agent(agent, pos) # Place the agent in the grid
         
     def add_cars(self):
         isBlocked = True
         for car in range(len(self.spawn_points)):
-                    dest = random.choice(self.destinations) #choose a random destination
-                    new_map = self.map.copy() #copy the map              
-                    agent = Car(f"c_{self.total_cars}", self, dest, new_map, self.spawn_points[car], self.paciencia) #create a new car
-                    content = self.grid.get_cell_list_contents(self.spawn_points[car])
-                    if any(isinstance(x, Car) for x in content):  # if there is alreade a agent in the cell do not add a new one                          
+                    dest = self.random.choice(self.destinations) #choose a random destination
+                    if self.engine is not None:
+                        patience = self.random.randint(self.paciencia, self.paciencia * 2) # Same draw as Car.__init__
+                        if self.engine.is_occupied(self.spawn_points[car]):
+                            break
+                        self.engine.add_car(self.total_cars, self.spawn_points[car], dest, patience)
+                        self.car_count += 1
+                        self.total_cars += 1
+                        isBlocked = False
+                        continue
+                    agent = Car(f"c_{self.total_cars}", self, dest, self.router, self.spawn_points[car], self.paciencia) #create a new car
+                    if self.occupancy[self.spawn_points[car]]:  # if there is alreade a agent in the cell do not add a new one                          
                         break
                     else:
                         self.grid.place_agent(agent, self.spawn_points[car]) #place the agent in the grid
+                        self.occupancy[self.spawn_points[car]] = True
                         self.schedule.add(agent)  # Add the agent to the schedule
+                        self.cars[agent.unique_id] = agent
                         self.car_count += 1 
                         self.total_cars += 1
                         isBlocked = False
@@ -138,7 +143,92 @@ class CityModel(Model):
         
         
 
+    def occupied_nodes(self):
+        """
+        Boolean array with the nodes of the router that have a car, for either engine
+        """
+        if self.engine is not None:
+            return self.engine.occupied_nodes()
+        return self.occupancy[self.router.nodes[:, 0], self.router.nodes[:, 1]]
+
+    def set_lights(self, lights):
+        """
+        Gives the traffic lights in a list the state chosen by the signal controller
+        """
+        for i in lights:
+            self.traffic_lights[i].state = bool(self.signals.state[i])
+        if self.engine is not None:
+            self.engine.light_state[lights] = self.signals.state[lights]
+
+    def spawn(self, sources, goals, paths):
+        """
+        Adds a batch of cars with their paths already calculated, at free cells.
+        Args:
+            sources, goals: Node indices where each car appears and where it goes
+            paths: Path of each car as node indices, from its source to its goal
+        """
+        nodes = self.router.nodes
+        numbers = range(self.total_cars, self.total_cars + len(sources))
+        if self.engine is not None:
+            patience = [self.random.randint(self.paciencia, self.paciencia * 2) for _ in sources] # Same draws as Car.__init__
+            self.engine.add_cars(numbers, sources, goals, patience, paths)
+        else:
+            for number, source, goal, path in zip(numbers, sources, goals, paths):
+                pos = tuple(nodes[source].tolist())
+                agent = Car(f"c_{number}", self, tuple(nodes[goal].tolist()), self.router, pos, self.paciencia, path)
+                self.grid.place_agent(agent, pos)
+                self.occupancy[pos] = True
+                self.schedule.add(agent)
+                self.cars[agent.unique_id] = agent
+        self.car_count += len(sources)
+        self.total_cars += len(sources)
+
+    def find_paths(self, jobs):
+        """
+        Paths of a batch of cars that need one. They only depend on each car, so they can be found in any order.
+        Args:
+            jobs: List of (source, target, penalties, ahead), the arguments of Router.reroute
+        Returns the list of (path, i) of Router.reroute, in the order of the jobs
+        """
+        if not jobs:
+            return []
+        start = time.perf_counter()
+        field = self.congestion
+        costs, tolerance = (field.costs, field.tolerance) if field is not None else (None, 0.0)
+        found = [self.router.reroute(*job, congestion=costs, tolerance=tolerance) for job in jobs]
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.add("route", start)
+            for path, i in found:
+                if i is not None:
+                    metrics.count("repairs")
+                    continue
+                metrics.count("routes")
+                if path is not None:
+                    metrics.path_length.observe(len(path))
+        return found
+
+    def compact_paths(self):
+        """
+        Drops the paths the cars left behind by rerouting once they are most of the arena, like ArrayEngine.step
+        """
+        cars = list(self.cars.values())
+        used = sum([car.end - car.cursor for car in cars])
+        if self.arena.size > 4 * used + 4096:
+            starts, ends = self.arena.compact(np.array([car.cursor for car in cars], dtype=np.int64), np.array([car.end for car in cars], dtype=np.int64))
+            for car, start, end in zip(cars, starts.tolist(), ends.tolist()):
+                car.cursor, car.end = start, end
+
+    def car_positions(self):
+        """
+        List of (id, (x, y)) of the cars in the simulation, for either engine
+        """
+        if self.engine is not None:
+            return self.engine.car_positions()
+        return [(car.unique_id, car.pos) for car in self.cars.values()]
+
     def plot_graph(self, graph):
+        import matplotlib.pyplot as plt # Only needed here, the headless runs never import it
         pos = {node: (node[0], -node[1]) for node in graph.nodes}  # Flip y-axis for visualization
         nx.draw(graph, pos, with_labels=True, node_size=700, node_color='skyblue', font_size=8, font_color='black')
         labels = nx.get_edge_attributes(graph,'weight')
@@ -146,7 +236,30 @@ class CityModel(Model):
         plt.show()
 
     def step(self):
-        if self.step_count%3 == 0 and self.step_count != 0: #every n steps add a new car
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.begin_step()
+        if self.demand is not None:
+            start = time.perf_counter()
+            self.demand.inject(self)
+            if metrics is not None:
+                metrics.add("spawn", start)
+        elif self.step_count%3 == 0 and self.step_count != 0: #every n steps add a new car
+            start = time.perf_counter()
             self.add_cars()
+            if metrics is not None:
+                metrics.add("spawn", start)
         self.step_count += 1
-        self.schedule.step()  
\ No newline at end of file
+        changed = self.signals.step(self.occupied_nodes())
+        if len(changed):
+            self.set_lights(changed)
+        if self.engine is not None:
+            self.engine.step()
+        else:
+            self.schedule.step()
+            self.compact_paths()
+        if self.congestion is not None:
+            self.congestion.update(self.occupied_nodes())
+        if metrics is not None:
+            metrics.end_step()
+  
\ No newline at end of file
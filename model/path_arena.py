@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class PathArena:
+    """
+    One int32 buffer holding the paths of every car back to back.
+    A car only keeps a cursor (its next node) and the end of its path, rerouting appends
+    a new path and leaves the old one as garbage until the next compaction.
+    """
+    def __init__(self, capacity = 1024):
+        self.data = np.zeros(capacity, dtype=np.int32)
+        self.size = 0 # Used part of the buffer, including garbage
+
+    def append(self, path):
+        """
+        Stores a path (node indices) and returns its (start, end) in the buffer
+        """
+        start = self.size
+        end = start + len(path)
+        if end > len(self.data): # Grow the buffer
+            data = np.zeros(max(2 * len(self.data), end), dtype=np.int32)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[start:end] = path
+        self.size = end
+        return start, end
+
+    def extend(self, paths):
+        """
+        Stores several paths at once and returns the arrays of their starts and ends in the buffer
+        """
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        ends = self.size + np.cumsum(lengths)
+        if len(paths):
+            self.append(np.concatenate([np.asarray(path, dtype=np.int32) for path in paths]))
+        return ends - lengths, ends
+
+    def compact(self, starts, ends):
+        """
+        Moves the live parts of the paths, [starts[i], ends[i]), to the front of the buffer.
+        Returns the new (starts, ends) arrays.
+        """
+        lengths = ends - starts
+        new_ends = np.cumsum(lengths)
+        new_starts = new_ends - lengths
+        data = np.zeros(max(2 * int(lengths.sum()), 1024), dtype=np.int32) # Room to grow, without keeping the garbage
+        if len(lengths):
+            # Index of every live element in the old buffer, built without a python loop
+            offsets = np.arange(new_ends[-1]) - np.repeat(new_starts, lengths)
+            data[:new_ends[-1]] = self.data[np.repeat(starts, lengths) + offsets]
+            self.size = int(new_ends[-1])
+        else:
+            self.size = 0
+        self.data = data
+        return new_starts.astype(starts.dtype), new_ends.astype(ends.dtype)
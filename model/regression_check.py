@@ -0,0 +1,128 @@
+# Checks the guarantees the model relies on, with fixed seeds on the base maps:
+#   - the "objects" and "array" engines take exactly the same steps,
+#   - a restored checkpoint goes on exactly like the original run, also with the other engine,
+#   - the frames of /stream (DeltaDecoder) rebuild the same cars and lights /getAgents returns.
+# Run from the model directory after changing the model: python regression_check.py
+# It prints a line per case and exits with 1 at the first case that does not hold.
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+from model import CityModel
+from checkpoint import checkpoint, restore
+from step_buffer import Snapshot
+from streaming import DeltaEncoder, DeltaDecoder, SIZE
+
+MAPS = ["city_files/2021_base.txt", "city_files/2022_base.txt", "city_files/2023_base.txt"]
+SIGNALS = ["legacy", "max_pressure"]
+DEMAND = {"sources": "border", "rate": 2}
+
+
+def state(model):
+    """
+    Everything a client can see of a model after a step
+    """
+    return (sorted(model.car_positions()), [light.state for light in model.traffic_lights],
+            model.arrived_cars, model.total_cars, model.car_count, model.running)
+
+
+def quiet(function, *args, **kwargs):
+    """
+    Calls function without the prints of the model
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def check_engines(steps, **params):
+    """
+    Steps both engines side by side. Returns None if they always match, otherwise the first step where they differ.
+    """
+    objects = quiet(CityModel, engine="objects", **params)
+    array = quiet(CityModel, engine="array", **params)
+    for step in range(steps):
+        quiet(objects.step)
+        quiet(array.step)
+        if state(objects) != state(array):
+            return step
+    return None
+
+
+def check_checkpoint(steps, engine, **params):
+    """
+    Runs a model for steps, checkpoints it and runs it and a fork with each engine for steps more.
+    Returns None if the forks always match the original, otherwise the first step after the checkpoint where one differs.
+    """
+    model = quiet(CityModel, engine=engine, **params)
+    for _ in range(steps):
+        quiet(model.step)
+    data = checkpoint(model)
+    forks = [quiet(restore, data, engine=other) for other in ["objects", "array"]]
+    for step in range(steps):
+        for run in [model] + forks:
+            quiet(run.step)
+        if any(state(fork) != state(model) for fork in forks):
+            return step
+    return None
+
+
+def check_stream(steps, keyframe_every, **params):
+    """
+    Encodes every step of a model like /stream and decodes it like a client.
+    Returns None if the decoded state is always the body of /getAgents of the same step, otherwise the first step where it is not.
+    """
+    model = quiet(CityModel, **params)
+    encoder, decoder = DeltaEncoder(model, keyframe_every), DeltaDecoder()
+    for step in range(steps + 1):
+        if step:
+            quiet(model.step)
+        snapshot = Snapshot(step, model)
+        frame = encoder.encode(snapshot.step, snapshot.cars, snapshot.lights)
+        decoder.feed(frame[SIZE.size:])
+        agents = json.loads(snapshot.agents_json)
+        cars = {int(car["id"][2:]): (car["x"], car["z"]) for car in agents["positions"]}
+        lights = [[light["x"], light["z"], light["isGreen"]] for light in agents["traffic_lights"]]
+        if decoder.step != step or decoder.cars != cars or decoder.lights != lights:
+            return step
+    return None
+
+
+def cases(maps, seeds):
+    """
+    (name, check, arguments) of every case
+    """
+    for map_file in maps:
+        for seed in seeds:
+            for signals in SIGNALS:
+                params = {"map_file": map_file, "seed": seed, "signals": signals, "paciencia": 1 + seed % 3}
+                name = f"{map_file} seed {seed} {signals}"
+                yield f"engines {name}", check_engines, params
+                yield f"engines {name} demand", check_engines, {**params, "demand": DEMAND}
+                for engine in ["objects", "array"]:
+                    yield f"checkpoint {engine} {name} demand", check_checkpoint, {**params, "engine": engine, "demand": DEMAND}
+            yield f"stream {map_file} seed {seed}", check_stream, {"map_file": map_file, "seed": seed, "engine": "array", "keyframe_every": 7}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that the engines, checkpoints and streams give the same runs")
+    parser.add_argument("--maps", nargs="+", default=MAPS)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1])
+    parser.add_argument("--steps", type=int, default=300, help="Steps of each run, checkpoints are taken at half of them")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, check, params in cases(args.maps, args.seeds):
+        steps = args.steps // 2 if check is check_checkpoint else args.steps
+        step = check(steps, **params)
+        print(("ok    " if step is None else f"FAILED at step {step}: ") + name)
+        sys.stdout.flush()
+        failed += step is not None
+    if failed:
+        print(f"{failed} cases failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
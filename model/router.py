@@ -0,0 +1,320 @@
+import heapq
+import numpy as np
+
+REPAIR_WINDOW = 8 # Nodes of the current path ahead of the car a detour can join
+REPAIR_BUDGET = 32 # Most nodes a detour search settles before giving up
+
+
+class Router:
+    """
+    Routing engine compiled from the city graph.
+    The DiGraph built by city_map.init_Graph is turned once into CSR arrays
+    (one row of outgoing edges per node), so cars never touch networkx again.
+    Attributes:
+        nodes: (n, 2) array with the (x, y) position of each node
+        index: Dictionary from an (x, y) position to its node index
+        indptr, indices, weights: CSR arrays of the outgoing edges of each node
+    """
+    def __init__(self, nodes, indptr, indices, weights):
+        """
+        Builds the router from its arrays, see from_graph to compile a graph.
+        Args:
+            nodes: (x, y) position of each node
+            indptr, indices, weights: CSR arrays of the outgoing edges of each node
+        Raises ValueError if a weight is negative or NaN, the searches would never end.
+        """
+        self.nodes = np.asarray(nodes, dtype=np.int32).reshape(-1, 2)
+        self.index = {node: i for i, node in enumerate(map(tuple, self.nodes.tolist()))} # Position -> node index
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if not (self.weights >= 0).all(): # Also false for NaN
+            raise ValueError("The weights of the edges must be numbers of at least 0")
+        nodes = self.nodes
+        weights = self.weights
+
+        # Incoming edges of each node (edge ids sorted by target) to grow the trees from the destinations
+        sources = np.repeat(np.arange(len(nodes), dtype=np.int32), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind='stable').astype(np.int32)
+        self.rindptr = np.searchsorted(self.indices[order], np.arange(len(nodes) + 1)).astype(np.int32)
+        self.rsources = sources[order]
+        self.redges = order
+
+        # Cheapest cost of one unit of manhattan distance, keeps the A* heuristic admissible
+        span = np.abs(self.nodes[self.indices] - self.nodes[sources]).sum(axis=1)
+        self.h_scale = float((self.weights / np.maximum(span, 1)).min()) if len(weights) else 0.0
+
+        # Plain lists for the search loops, indexing numpy scalars one by one is slow
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+        self._rindptr = self.rindptr.tolist()
+        self._rsources = self.rsources.tolist()
+        self._redges = self.redges.tolist()
+        self._x = self.nodes[:, 0].tolist()
+        self._y = self.nodes[:, 1].tolist()
+        self._zeros = [0.0] * len(nodes) # No congestion
+
+        self.trees = {} # Destination index -> (distance to it, next node towards it) for every node
+        self._tree_lists = {} # Same trees as plain lists for the search loops
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Compiles a graph into arrays.
+        Args:
+            graph: networkx DiGraph whose nodes are (x, y) positions and whose edges have a 'weight'
+        """
+        nodes = list(graph.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        indptr = [0]
+        indices = []
+        weights = []
+        for node in nodes: # Outgoing edges of each node, one row per node
+            for neighbor, data in graph[node].items():
+                indices.append(index[neighbor])
+                weights.append(data['weight'])
+            indptr.append(len(indices))
+        return cls(nodes, indptr, indices, weights)
+
+    def add_trees(self, targets, dist, next_hop):
+        """
+        Adds trees built before (by another router of the same graph)
+        Args:
+            targets: Node index of each tree
+            dist, next_hop: One row per tree, see tree
+        """
+        for target, d, n in zip(np.asarray(targets).tolist(), dist, next_hop):
+            self.trees[target] = (d, n)
+            self._tree_lists[target] = (d.tolist(), n.tolist())
+
+    def precompute(self, destinations):
+        """
+        Builds the shortest path tree of each destination ahead of time
+        """
+        for dest in destinations:
+            if dest in self.index:
+                self.tree(self.index[dest])
+
+    def tree(self, target):
+        """
+        Reverse shortest path tree towards a node index, built with Dijkstra on the incoming edges.
+        Returns the arrays (dist, next_hop); next_hop is -1 where the target can not be reached.
+        """
+        if target not in self.trees:
+            self._build_tree(target)
+        return self.trees[target]
+
+    def _build_tree(self, target):
+        """
+        Dijkstra from the target following the edges backwards
+        """
+
+        n = len(self._x)
+        dist = [float('inf')] * n
+        next_hop = [-1] * n
+        dist[target] = 0.0
+        heap = [(0.0, target)]
+        rindptr, rsources, redges, weights = self._rindptr, self._rsources, self._redges, self._weights
+
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]: # Stale entry
+                continue
+            for k in range(rindptr[v], rindptr[v + 1]): # Every edge u -> v
+                u = rsources[k]
+                nd = d + weights[redges[k]]
+                if nd < dist[u]:
+                    dist[u] = nd
+                    next_hop[u] = v
+                    heapq.heappush(heap, (nd, u))
+
+        self.trees[target] = (np.array(dist), np.array(next_hop, dtype=np.int32))
+        self._tree_lists[target] = (dist, next_hop)
+
+    def edge_id(self, u, v):
+        """
+        Id of the edge between two positions, -1 if there is none
+        """
+        if u not in self.index or v not in self.index:
+            return -1
+        return self.edge_between(self.index[u], self.index[v])
+
+    def edge_between(self, ui, vi):
+        """
+        Id of the edge between two node indices, -1 if there is none
+        """
+        for k in range(self._indptr[ui], self._indptr[ui + 1]):
+            if self._indices[k] == vi:
+                return k
+        return -1
+
+    def path_indices(self, source, target, penalties=None, congestion=None, tolerance=0.0):
+        """
+        Shortest path between two node indices, including both ends.
+        The path is read from the tree of the target, unless there are penalties or more than tolerance of
+        congestion on it (see CongestionField.tolerance), then A* is used.
+        Returns None if there is no path.
+        """
+        if penalties:
+            return self.a_star(source, target, penalties, congestion)
+
+        self.tree(target)
+        dist, next_hop = self._tree_lists[target]
+        if dist[source] == float('inf'):
+            return None
+        path = [source]
+        node = source
+        while node != target: # Follow the tree towards the target
+            node = next_hop[node]
+            path.append(node)
+        if congestion is not None and sum([congestion[node] for node in path]) > tolerance:
+            return self.a_star(source, target, {}, congestion) # Only A* can go around the congestion, without it the tree path is the best
+        return path
+
+    def a_star(self, source, target, penalties, congestion=None):
+        """
+        A* between two node indices using the manhattan distance as heuristic.
+        If the tree of the target was already built its distances are used instead, they ignore
+        the penalties so they never overestimate and are much closer than the manhattan distance.
+        Args:
+            penalties: Dictionary edge id -> extra weight of that edge
+            congestion: List with the extra weight of getting into each node (see CongestionField.costs), or None
+        """
+        indptr, indices, weights, xs, ys = self._indptr, self._indices, self._weights, self._x, self._y
+        extra = congestion if congestion is not None else self._zeros
+        tx, ty, scale = xs[target], ys[target], self.h_scale
+        tree = self._tree_lists.get(target)
+        exact = tree[0] if tree is not None else None
+
+        g = {source: 0.0}
+        parent = {source: -1}
+        heap = [(exact[source] if exact else (abs(xs[source] - tx) + abs(ys[source] - ty)) * scale, 0.0, source)]
+        closed = set()
+
+        while heap:
+            _, gu, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if u in closed:
+                continue
+            closed.add(u)
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                gv = gu + weights[k] + penalties.get(k, 0) + extra[v]
+                if gv < g.get(v, float('inf')):
+                    g[v] = gv
+                    parent[v] = u
+                    hv = exact[v] if exact else (abs(xs[v] - tx) + abs(ys[v] - ty)) * scale
+                    heapq.heappush(heap, (gv + hv, gv, v))
+        else:
+            return None
+
+        path = [target]
+        while parent[path[-1]] != -1: # Walk back to the source
+            path.append(parent[path[-1]])
+        return path[::-1]
+
+    def detour(self, path, penalties, budget=REPAIR_BUDGET, congestion=None):
+        """
+        Repairs a path locally after the penalty of one of its first edges went up, instead of a new A*.
+        Searches from the first node for the cheapest way to get back onto the path, the rest of the
+        path is kept as it is, so the work depends on the size of the detour and not of the map.
+        Args:
+            path: The first nodes of the current path (see REPAIR_WINDOW) as node indices, starting at the current node
+            penalties: Dictionary edge id -> extra weight of that edge
+            budget: Most nodes to settle
+            congestion: Extra weight of getting into each node, see a_star
+        Returns (detour, i): the new way from the first node to path[i], both included, so the repaired
+        path is detour + path[i + 1:]. None if no detour was found within the budget.
+        """
+        while len(path) > 1 and path[1] == path[0]: # A new path starts at the current node
+            path = path[1:]
+        if len(path) < 2:
+            return None
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        extra = congestion if congestion is not None else self._zeros
+
+        # Cost from each node of the window to its last node, following the path
+        rest = [0.0] * len(path)
+        for i in range(len(path) - 2, -1, -1):
+            k = self.edge_between(path[i], path[i + 1])
+            if k == -1:
+                return None
+            rest[i] = rest[i + 1] + weights[k] + penalties.get(k, 0) + extra[path[i + 1]]
+        joins = {}
+        for i in range(len(path) - 1, 0, -1): # The first time each node shows up
+            joins[path[i]] = i
+
+        source = path[0]
+        g = {source: 0.0}
+        parent = {source: -1}
+        heap = [(0.0, source)]
+        closed = set()
+        best, best_join = float('inf'), None
+        while heap and len(closed) < budget:
+            gu, u = heapq.heappop(heap)
+            if gu > best: # Nothing left can join the path cheaper
+                break
+            if u in closed:
+                continue
+            closed.add(u)
+            if u in joins and gu + rest[joins[u]] <= best:
+                best, best_join = gu + rest[joins[u]], u
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                gv = gu + weights[k] + penalties.get(k, 0) + extra[v]
+                if gv < g.get(v, float('inf')):
+                    g[v] = gv
+                    parent[v] = u
+                    heapq.heappush(heap, (gv, v))
+
+        if best_join is None:
+            return None
+        detour = [best_join]
+        while parent[detour[-1]] != -1: # Walk back to the first node
+            detour.append(parent[detour[-1]])
+        return detour[::-1], joins[best_join]
+
+    def reroute(self, source, target, penalties, ahead = None, congestion = None, tolerance = 0.0):
+        """
+        Path of a car that has to find another one, see CityModel.find_paths.
+        Args:
+            source, target: Node indices of the car and its destination
+            penalties: Dictionary edge id -> extra weight of that edge, of the car (None if it has none)
+            ahead: The first nodes of its current path to try a detour first (see detour), None for a new path
+            congestion, tolerance: Extra weight of getting into each node and how much of it a free-flow path can have, see path_indices
+        Returns (detour, i) like detour when there is one, otherwise (path, None) with the new path, None if there is none.
+        """
+        if ahead is not None:
+            found = self.detour(ahead, penalties, congestion=congestion)
+            if found is not None:
+                return found
+        return self.path_indices(source, target, penalties, congestion, tolerance), None
+
+    def path_cost(self, path, penalties=None):
+        """
+        Total weight of a path given as node indices
+        """
+        cost = 0.0
+        for u, v in zip(path, path[1:]):
+            k = self.edge_id((self._x[u], self._y[u]), (self._x[v], self._y[v]))
+            cost += self._weights[k] + (penalties.get(k, 0) if penalties else 0)
+        return cost
+
+    def position(self, node):
+        """
+        (x, y) position of a node index
+        """
+        return (self._x[node], self._y[node])
+
+    def shortest_path(self, source, target, penalties=None, congestion=None):
+        """
+        Shortest path between two (x, y) positions, including both ends, or None if there is none
+        """
+        if source not in self.index or target not in self.index:
+            return None
+        path = self.path_indices(self.index[source], self.index[target], penalties, congestion)
+        if path is None:
+            return None
+        return [(self._x[i], self._y[i]) for i in path]
@@ -4,7 +4,8 @@ from mesa.visualization import CanvasGrid, BarChartModule
 from mesa.visualization import ModularServer
 from mesa.visualization.modules import TextElement
 
-from mesa.visualization import Slider
+from mesa.visualization import Slider, Choice
+from signals import POLICIES
 
 
 def agent_portrayal(agent):
@@ -55,6 +56,8 @@ model_params = {
     "diagonales": Slider("Respetuosos", 1.5, 0.5, 5.0, 0.1),
     "paciencia": Slider("Pascientes", 1.0, 1.0, 10.0, 1.0),
     "semaforos": Slider("Energicos", 1.0, 1.0, 40.0, 5.0),
+    "signals": Choice("Semáforos", "legacy", list(POLICIES)),
+    "static_agents": True, # The grid draws the roads, obstacles and destinations
 }
 
 
@@ -0,0 +1,199 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from model import CityModel
+from checkpoint import checkpoint
+from step_buffer import Snapshot, StepBuffer
+
+
+class SessionNotFound(Exception):
+    """
+    The session does not exist, it was never created, it was closed or it was evicted
+    """
+
+
+class SessionPoolFull(Exception):
+    """
+    Every session of the pool is busy, so no new one can be created
+    """
+
+
+class Session:
+    """
+    The simulation of one client.
+    Attributes:
+        id: Id returned by /init, clients send it back in every request
+        model: Its own CityModel
+        current_step: Number of steps the client has advanced
+        lock: Held while the model is stepped or read, so a session is never used by two threads at once
+        last_used: time.monotonic() of the last request, for the idle eviction
+        buffer: StepBuffer computing steps ahead of the client, None to step the model on each request
+    """
+    def __init__(self, id, model, run_ahead = 0):
+        """
+        Args:
+            run_ahead: Steps to compute ahead of the client, 0 to not run ahead
+        """
+        self.id = id
+        self.model = model
+        self.current_step = model.step_count # Not 0 for a model restored from a checkpoint
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.buffer = StepBuffer(self, run_ahead) if run_ahead else None
+
+    def step(self):
+        """
+        Advances the model one step and returns the new step number
+        """
+        if self.buffer is not None:
+            self.current_step = self.buffer.advance().step
+            self.last_used = time.monotonic()
+            return self.current_step
+        with self.lock:
+            self.model.step()
+            self.current_step += 1
+            self.last_used = time.monotonic()
+            return self.current_step
+
+    def snapshot(self):
+        """
+        Snapshot of the step the client is at
+        """
+        if self.buffer is not None:
+            return self.buffer.current
+        with self.lock:
+            return Snapshot(self.current_step, self.model)
+
+    def checkpoint(self):
+        """
+        Checkpoint of the model (see checkpoint.py) and its step. When the session runs ahead it is
+        the last step computed, which can be ahead of the client.
+        """
+        with self.lock:
+            return self.model.step_count, checkpoint(self.model)
+
+    def close(self):
+        """
+        Stops computing steps ahead, the session is not used anymore
+        """
+        if self.buffer is not None:
+            self.buffer.stop()
+
+
+class SessionPool:
+    """
+    Bounded pool of sessions. Steps run on a pool of worker threads, each session behind its own lock,
+    so a slow session does not hold back the others.
+    """
+    def __init__(self, max_sessions = 16, idle_timeout = 600, workers = 4, run_ahead = 0):
+        """
+        Args:
+            max_sessions: Most sessions alive at once
+            idle_timeout: Seconds without requests after which a session is dropped
+            workers: Threads stepping the models
+            run_ahead: Steps each session computes ahead of its client (see StepBuffer), 0 to not run ahead
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.run_ahead = run_ahead
+        self.sessions = OrderedDict() # Id -> Session, the least recently used first
+        self.lock = threading.Lock() # Protects the dictionary, not the models
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session")
+        self.default = None # Id of the session used by the requests without one (the last one created)
+
+    def _evict_idle(self):
+        """
+        Drops the sessions that have been idle for too long, the pool lock must be held
+        """
+        now = time.monotonic()
+        for id in [id for id, session in self.sessions.items() if now - session.last_used > self.idle_timeout]:
+            self.sessions.pop(id).close()
+
+    def create(self, **params):
+        """
+        Creates a session with a new CityModel(**params). If the pool is full the least recently used
+        session that is not busy is dropped. Raises SessionPoolFull if all of them are busy.
+        """
+        return self.add(CityModel(**params)) # Outside of the pool lock, building a model is slow
+
+    def add(self, model):
+        """
+        Creates a session for a model that is already built, like one restored from a checkpoint.
+        Same as create otherwise.
+        """
+        with self.lock:
+            self._evict_idle()
+            while len(self.sessions) >= self.max_sessions:
+                idle = next((id for id, session in self.sessions.items() if not session.lock.locked()), None)
+                if idle is None:
+                    raise SessionPoolFull()
+                self.sessions.pop(idle).close()
+
+            session = Session(uuid.uuid4().hex[:12], model, self.run_ahead)
+            self.sessions[session.id] = session
+            self.default = session.id
+            return session
+
+    def reset(self, id, **params):
+        """
+        Starts the session over with a new CityModel(**params), keeping its id.
+        The steps it had computed ahead are dropped. Raises SessionNotFound if there is none with that id.
+        """
+        return self.replace(id, CityModel(**params))
+
+    def replace(self, id, model):
+        """
+        Starts the session over with a model that is already built, same as reset otherwise
+        """
+        with self.lock:
+            if id not in self.sessions:
+                raise SessionNotFound(id)
+            self.sessions[id].close()
+            session = Session(id, model, self.run_ahead)
+            self.sessions[id] = session
+            self.sessions.move_to_end(id)
+            return session
+
+    def get(self, id = None):
+        """
+        Session with that id, or the default one. Raises SessionNotFound if there is none.
+        """
+        with self.lock:
+            self._evict_idle()
+            id = id or self.default
+            if id not in self.sessions:
+                raise SessionNotFound(id)
+            self.sessions.move_to_end(id)
+            session = self.sessions[id]
+            session.last_used = time.monotonic()
+            return session
+
+    def all(self):
+        """
+        List of the sessions alive, the least recently used first
+        """
+        with self.lock:
+            return list(self.sessions.values())
+
+    def close(self, id):
+        """
+        Drops a session. Raises SessionNotFound if there is none with that id.
+        """
+        with self.lock:
+            session = self.sessions.pop(id, None)
+            if session is None:
+                raise SessionNotFound(id)
+            session.close()
+            if self.default == id:
+                self.default = None
+
+    def step(self, session):
+        """
+        Advances a session one step on a worker thread and returns the new step number.
+        A session that runs ahead already has the step ready, so it is taken right away.
+        """
+        if session.buffer is not None:
+            return session.step()
+        return self.executor.submit(session.step).result()
@@ -0,0 +1,249 @@
+"""
+Signal control of the traffic lights.
+
+The lights of the map are grouped into intersections: the cells of one light in the map ("SS", "ss")
+form a group (CompiledMap.light_group), one group per street coming in, and groups whose cells touch,
+diagonals included, belong to the same intersection. Each intersection runs as a list of phases with
+one group green at a time. An intersection with a single group also gets a phase with no green light,
+for the crossing street that has none.
+
+Every step the controller counts the cars near each group in one vectorized pass over the occupied
+nodes of the model: the queue is the cars on the cells that lead to the group and the downstream
+count the cars on the cells right after it. A policy (a subclass of SignalController, see POLICIES)
+decides from them which phase each intersection shows.
+"""
+import numpy as np
+
+REACH = 6 # Cells before and after a traffic light where its cars are counted
+
+
+class SignalController:
+    """
+    Runs the traffic lights of a CityModel. This base class is the legacy policy: every light flips by
+    itself every timeToChange steps (see Traffic_Light.step) and the controller only counts the queues.
+    Attributes:
+        self_timed: Whether the lights flip by themselves, False when the controller sets them
+        group: Group of each traffic light
+        first: First phase of each intersection, the phases of an intersection are consecutive
+        phase_group: Group that is green in each phase, -1 for none
+        duration: Steps of each phase in a fixed cycle, the timeToChange of its lights
+        current: Phase each intersection shows
+        elapsed: Steps since each intersection changed its phase
+        state: State of each traffic light (True = green), only kept up to date by the policies that set them
+        queued: Sum over the steps of the cars queued before the traffic lights
+        switches: Number of phase changes
+    """
+    self_timed = True
+
+    def __init__(self, model, reach = REACH):
+        """
+        Args:
+            model: The CityModel, its traffic lights must already be created
+            reach: Cells before and after each light where the cars are counted
+        """
+        lattice, router = model.lattice, model.router
+        self.group = np.asarray(model.city.light_group, dtype=np.int64)
+        n_groups = int(self.group.max()) + 1 if len(self.group) else 0
+
+        # Intersections: union of the groups with lights in touching cells
+        parent = list(range(n_groups))
+        def root(g):
+            while parent[g] != g:
+                parent[g] = parent[parent[g]]
+                g = parent[g]
+            return g
+        for light, (x, y) in enumerate(lattice.light_pos):
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    pos = (x + dx, y + dy)
+                    if 0 <= pos[0] < lattice.width and 0 <= pos[1] < lattice.height and lattice.light_id[pos] >= 0:
+                        parent[root(int(self.group[lattice.light_id[pos]]))] = root(int(self.group[light]))
+
+        members = {} # Root -> groups of the intersection, in the order of their first light
+        for g in range(n_groups):
+            members.setdefault(root(g), []).append(g)
+        green = np.zeros(n_groups, dtype=bool)
+        green[self.group[lattice.light_state]] = True # Groups that start green
+        times = np.zeros(n_groups, dtype=np.int64)
+        times[self.group] = lattice.light_time
+
+        first, phase_group, current = [], [], []
+        for groups in members.values():
+            first.append(len(phase_group))
+            phases = groups if len(groups) > 1 else groups + [-1]
+            start = [p for p, g in enumerate(phases) if g >= 0 and green[g]]
+            current.append(first[-1] + (start[0] if start else len(phases) - 1))
+            phase_group += phases
+        self.first = np.array(first, dtype=np.int64)
+        self.phase_group = np.array(phase_group, dtype=np.int64)
+        self.phase_intersection = np.repeat(np.arange(len(first)), np.diff(first + [len(phase_group)]))
+        # The phase with no light lasts as long as the only group of its intersection
+        self.duration = times[self.phase_group]
+        lone = np.flatnonzero(self.phase_group < 0)
+        self.duration[lone] = times[self.phase_group[lone - 1]]
+        self.next_phase = np.arange(1, len(phase_group) + 1)
+        last = np.array(first[1:] + [len(phase_group)], dtype=np.int64)[:len(first)] - 1
+        self.next_phase[last] = self.first # The last phase of an intersection goes back to the first one
+        self.current = np.array(current, dtype=np.int64)
+        self.elapsed = np.zeros(len(current), dtype=np.int64)
+
+        # Nodes watched for each group: before it (slot = group) and after it (slot = n_groups + group)
+        light_node = [router.index[pos] for pos in lattice.light_pos]
+        is_light = np.zeros(len(router.nodes), dtype=bool)
+        is_light[light_node] = True
+        starts = [[] for _ in range(n_groups)]
+        for light, node in enumerate(light_node):
+            starts[self.group[light]].append(node)
+        watch_node, watch_slot = [], []
+        for g, nodes in enumerate(starts):
+            for slot, indptr, indices in [(g, router._rindptr, router._rsources), (n_groups + g, router._indptr, router._indices)]:
+                found = reachable(nodes, indptr, indices, is_light, reach)
+                watch_node += found
+                watch_slot += [slot] * len(found)
+        self.watch_node = np.array(watch_node, dtype=np.int64)
+        self.watch_slot = np.array(watch_slot, dtype=np.int64)
+        self.n_groups = n_groups
+
+        self.state = self.lights()
+        self.queued = 0
+        self.switches = 0
+
+    def lights(self):
+        """
+        State of each traffic light for the current phases
+        """
+        green = np.zeros(self.n_groups + 1, dtype=bool) # The last one stands for the phases with no light
+        green[self.phase_group[self.current]] = True
+        green[-1] = False
+        return green[self.group]
+
+    def step(self, occupied):
+        """
+        Counts the queues and lets the policy choose the phases, at the start of a step.
+        Returns the traffic lights that changed (see state).
+        Args:
+            occupied: Boolean array with the nodes that have a car
+        """
+        counts = np.bincount(self.watch_slot, weights=occupied[self.watch_node], minlength=2 * self.n_groups)
+        queue, downstream = counts[:self.n_groups], counts[self.n_groups:]
+        self.queued += int(queue.sum())
+        if not len(self.current):
+            return []
+        self.elapsed += 1
+        current = self.decide(queue, downstream)
+        if current is None:
+            return []
+        switch = current != self.current
+        self.switches += int(switch.sum())
+        self.elapsed[switch] = 0
+        self.current = current
+        state = self.lights()
+        changed = np.flatnonzero(state != self.state)
+        self.state = state
+        return changed
+
+    def decide(self, queue, downstream):
+        """
+        New phase of each intersection, or None to leave the lights alone
+        Args:
+            queue: Cars before each group
+            downstream: Cars after each group
+        """
+        return None
+
+    def per_phase(self, values):
+        """
+        Value of the group of each phase, 0 for the phases with no light
+        """
+        return np.where(self.phase_group >= 0, values[np.maximum(self.phase_group, 0)], 0)
+
+    def best_other(self, values):
+        """
+        Phase with the largest value of each intersection besides the current one, and that value.
+        Ties go to the first phase.
+        """
+        values = values.astype(np.float64)
+        values[self.current] = -np.inf
+        best = np.maximum.reduceat(values, self.first)
+        candidate = np.where(values == best[self.phase_intersection], np.arange(len(values)), len(values))
+        return np.minimum.reduceat(candidate, self.first), best
+
+
+class FixedTime(SignalController):
+    """
+    Fixed cycle: each phase stays green for the timeToChange of its lights, then the next one of the
+    intersection. All the intersections start their cycle on the same step.
+    """
+    self_timed = False
+
+    def decide(self, queue, downstream):
+        done = self.elapsed >= self.duration[self.current]
+        return np.where(done, self.next_phase[self.current], self.current)
+
+
+class Actuated(SignalController):
+    """
+    Queue actuated: a phase stays green at least min_green steps and then while it has cars queued.
+    It gives way to the phase with the longest queue when its own queue is empty or after max_green steps.
+    A phase with no competition stays green.
+    """
+    self_timed = False
+
+    def __init__(self, model, reach = REACH, min_green = 4, max_green = 20):
+        super().__init__(model, reach)
+        self.min_green = min_green
+        self.max_green = max_green
+
+    def decide(self, queue, downstream):
+        demand = self.per_phase(queue)
+        other, waiting = self.best_other(demand)
+        empty = demand[self.current] == 0
+        switch = (self.elapsed >= self.min_green) & (waiting > 0) & (empty | (self.elapsed >= self.max_green))
+        return np.where(switch, other, self.current)
+
+
+class MaxPressure(SignalController):
+    """
+    Max pressure: the pressure of a phase is the queue before its green group minus the cars after it.
+    Every intersection shows the phase with the largest pressure, keeping each phase at least min_green
+    steps. Looking at the cars after the light holds back traffic that would only block the next street.
+    """
+    self_timed = False
+
+    def __init__(self, model, reach = REACH, min_green = 4):
+        super().__init__(model, reach)
+        self.min_green = min_green
+
+    def decide(self, queue, downstream):
+        pressure = self.per_phase(queue - downstream)
+        other, best = self.best_other(pressure)
+        switch = (self.elapsed >= self.min_green) & (best > pressure[self.current])
+        return np.where(switch, other, self.current)
+
+
+POLICIES = {
+    "legacy": SignalController,
+    "fixed": FixedTime,
+    "actuated": Actuated,
+    "max_pressure": MaxPressure,
+}
+
+
+def reachable(starts, indptr, indices, is_light, reach):
+    """
+    Nodes at most reach edges away from the start nodes through the edges of a CSR graph,
+    without going through traffic lights
+    """
+    seen = set(starts)
+    frontier = list(starts)
+    found = []
+    for _ in range(reach):
+        following = []
+        for u in frontier:
+            for v in indices[indptr[u]:indptr[u + 1]]:
+                if v not in seen and not is_light[v]:
+                    seen.add(v)
+                    following.append(v)
+        found += following
+        frontier = following
+    return found
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+class Snapshot:
+    """
+    State of a model after one step, everything /update, /getAgents and /stream send about it.
+    Attributes:
+        step: Step number as seen by the client
+        cars: List of (id, (x, y)) of the cars
+        lights: State of each traffic light, in the order of CityModel.traffic_lights
+    """
+    def __init__(self, step, model):
+        self.step = step
+        self.cars = model.car_positions()
+        self.lights = [light.state for light in model.traffic_lights]
+        self._lights = [(light.unique_id, light.pos) for light in model.traffic_lights]
+        self._json = None
+        self._metrics = model.metrics
+
+    @property
+    def agents_json(self):
+        """
+        Body of /getAgents, serialized once
+        """
+        if self._json is None:
+            start = time.perf_counter()
+            self._json = json.dumps({
+                'positions': [{"id": id, "x": pos[0], "y": 0, "z": pos[1]} for id, pos in self.cars],
+                'traffic_lights': [{"id": id, "x": pos[0], "y": 0, "z": pos[1], "isGreen": state}
+                                   for (id, pos), state in zip(self._lights, self.lights)],
+            }).encode()
+            if self._metrics is not None:
+                self._metrics.serialize_seconds.observe(time.perf_counter() - start)
+        return self._json
+
+
+class StepBuffer:
+    """
+    Runs a session ahead of its client. A background thread steps the model and keeps up to capacity
+    ready snapshots, so the client takes the next step without waiting for model.step().
+    When the client falls behind the buffer fills up and the thread waits for it.
+    """
+    def __init__(self, session, capacity = 8):
+        """
+        Args:
+            session: The Session to run ahead, its lock is held while its model is stepped
+            capacity: Most steps computed ahead of the client
+        """
+        self.session = session
+        self.capacity = capacity
+        self.ready = deque() # Snapshots computed but not taken by the client yet
+        self.condition = threading.Condition()
+        self.current = Snapshot(session.current_step, session.model) # The last snapshot taken by the client
+        self.computed = session.current_step # Step of the model
+        self.stopped = False
+        self.error = None # Exception raised by model.step(), given to the client
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"run-ahead-{session.id}")
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.ready) >= self.capacity and not self.stopped: # Backpressure
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+            try:
+                with self.session.lock:
+                    self.session.model.step()
+                    self.computed += 1
+                    snapshot = Snapshot(self.computed, self.session.model)
+                snapshot.agents_json # Serialize here and not in the request
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+                    self.stopped = True
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                if self.stopped: # Invalidated while stepping, drop it
+                    return
+                self.ready.append(snapshot)
+                self.condition.notify_all()
+
+    def advance(self):
+        """
+        Takes the next step, waiting only if the background thread has not computed it yet
+        """
+        with self.condition:
+            while not self.ready:
+                if self.error is not None:
+                    raise self.error
+                if self.stopped:
+                    raise RuntimeError("The run-ahead buffer was stopped")
+                self.condition.wait()
+            self.current = self.ready.popleft()
+            self.condition.notify_all()
+            return self.current
+
+    def stop(self):
+        """
+        Stops the background thread and drops the steps computed ahead
+        """
+        with self.condition:
+            self.stopped = True
+            self.ready.clear()
+            self.condition.notify_all()
@@ -0,0 +1,153 @@
+"""
+Binary delta frames of the simulation for the /stream endpoint.
+
+Every frame is a little endian uint32 with the size of the payload followed by the payload.
+The payload starts with a uint8 kind and the uint32 step:
+    KEYFRAME: uint32 lights, uint32 cars, then the whole state
+        lights * (uint16 x, uint16 y, uint8 green)    in the order of CityModel.traffic_lights
+        cars   * (uint32 id, uint16 x, uint16 y)      the car "c_12" has id 12
+    DELTA: uint32 spawns, uint32 moves, uint32 arrivals, uint32 flips, then only what changed
+        spawns   * (uint32 id, uint16 x, uint16 y)
+        moves    * (uint32 id, uint16 x, uint16 y)
+        arrivals * (uint32 id)
+        flips    * (uint32 light, uint8 green)        light is the index in the keyframe
+Positions are grid (x, y), the same as "x" and "z" in /getAgents.
+"""
+import struct
+import numpy as np
+
+KEYFRAME = 0
+DELTA = 1
+
+CAR = np.dtype([('id', '<u4'), ('x', '<u2'), ('y', '<u2')])
+LIGHT = np.dtype([('x', '<u2'), ('y', '<u2'), ('green', 'u1')])
+FLIP = np.dtype([('light', '<u4'), ('green', 'u1')])
+ARRIVAL = np.dtype('<u4')
+
+SIZE = struct.Struct('<I')
+KEYFRAME_HEADER = struct.Struct('<BIII')
+DELTA_HEADER = struct.Struct('<BIIIII')
+
+
+def car_records(cars):
+    """
+    Array of CAR records from a list of (id, (x, y))
+    """
+    records = np.zeros(len(cars), dtype=CAR)
+    if cars:
+        records['id'] = [id for id, _ in cars]
+        xy = np.array([pos for _, pos in cars])
+        records['x'], records['y'] = xy[:, 0], xy[:, 1]
+    return records
+
+
+class DeltaEncoder:
+    """
+    Turns the state of a model into frames, sending only what changed since the previous frame.
+    """
+    def __init__(self, model, keyframe_every = 50):
+        """
+        Args:
+            model: The CityModel to encode, for the positions of its traffic lights
+            keyframe_every: A full keyframe is sent every this many frames (at least 1), so a client can (re)join
+        """
+        if keyframe_every < 1:
+            raise ValueError("keyframe_every must be at least 1")
+        self.model = model
+        self.keyframe_every = keyframe_every
+        self.cars = {} # Car id -> position in the previous frame
+        self.lights = None # Light states in the previous frame
+        self.frames = 0
+
+    def encode(self, step, car_positions, light_states):
+        """
+        Frame with a state of the model (like a Snapshot of the run-ahead buffer), a keyframe or the changes since the previous call
+        Args:
+            car_positions: List of (id, (x, y)) of the cars, like CityModel.car_positions()
+            light_states: State of each traffic light of the model
+        """
+        cars = {int(id[2:]): pos for id, pos in car_positions} # "c_12" -> 12
+        lights = np.array(light_states, dtype=bool)
+
+        if self.lights is None or self.frames % self.keyframe_every == 0:
+            payload = self._keyframe(step, cars, lights)
+        else:
+            payload = self._delta(step, cars, lights)
+
+        self.cars, self.lights = cars, lights
+        self.frames += 1
+        return SIZE.pack(len(payload)) + payload
+
+    def _keyframe(self, step, cars, lights):
+        records = np.zeros(len(lights), dtype=LIGHT)
+        if len(lights):
+            positions = np.array([light.pos for light in self.model.traffic_lights])
+            records['x'], records['y'] = positions[:, 0], positions[:, 1]
+        records['green'] = lights
+        return KEYFRAME_HEADER.pack(KEYFRAME, step, len(lights), len(cars)) + records.tobytes() + car_records(list(cars.items())).tobytes()
+
+    def _delta(self, step, cars, lights):
+        previous = self.cars
+        spawns = [(id, pos) for id, pos in cars.items() if id not in previous]
+        moves = [(id, pos) for id, pos in cars.items() if id in previous and previous[id] != pos]
+        arrivals = np.array([id for id in previous if id not in cars], dtype=ARRIVAL)
+
+        flipped = np.flatnonzero(lights != self.lights)
+        flips = np.zeros(len(flipped), dtype=FLIP)
+        flips['light'], flips['green'] = flipped, lights[flipped]
+
+        header = DELTA_HEADER.pack(DELTA, step, len(spawns), len(moves), len(arrivals), len(flips))
+        return header + car_records(spawns).tobytes() + car_records(moves).tobytes() + arrivals.tobytes() + flips.tobytes()
+
+
+class DeltaDecoder:
+    """
+    Rebuilds the state from the frames of a DeltaEncoder, for Python clients and dashboards.
+    Attributes:
+        step: Step of the last frame
+        cars: Dictionary car id -> (x, y)
+        lights: List of [x, y, green] of each traffic light
+    """
+    def __init__(self):
+        self.step = None
+        self.cars = {}
+        self.lights = []
+
+    def feed(self, payload):
+        """
+        Applies one payload (a frame without its size prefix)
+        """
+        kind = payload[0]
+        if kind == KEYFRAME:
+            _, self.step, n_lights, n_cars = KEYFRAME_HEADER.unpack_from(payload)
+            offset = KEYFRAME_HEADER.size
+            lights = np.frombuffer(payload, LIGHT, n_lights, offset)
+            offset += lights.nbytes
+            cars = np.frombuffer(payload, CAR, n_cars, offset)
+            self.lights = [[int(x), int(y), bool(green)] for x, y, green in lights.tolist()]
+            self.cars = {id: (x, y) for id, x, y in cars.tolist()}
+            return
+
+        _, self.step, n_spawns, n_moves, n_arrivals, n_flips = DELTA_HEADER.unpack_from(payload)
+        offset = DELTA_HEADER.size
+        for count in [n_spawns, n_moves]:
+            cars = np.frombuffer(payload, CAR, count, offset)
+            offset += cars.nbytes
+            self.cars.update({id: (x, y) for id, x, y in cars.tolist()})
+        arrivals = np.frombuffer(payload, ARRIVAL, n_arrivals, offset)
+        offset += arrivals.nbytes
+        for id in arrivals.tolist():
+            del self.cars[id]
+        for light, green in np.frombuffer(payload, FLIP, n_flips, offset).tolist():
+            self.lights[light][2] = bool(green)
+
+    def read(self, stream):
+        """
+        Reads every frame of a binary stream (a file or an HTTP response), yielding after each one
+        """
+        while True:
+            size = stream.read(SIZE.size)
+            if len(size) < SIZE.size:
+                return
+            self.feed(stream.read(SIZE.unpack(size)[0]))
+            yield self